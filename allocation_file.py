@@ -0,0 +1,70 @@
+"""
+    Fixed-width binary file of precomputed daily allocations.
+
+    The file is a .npy array of shape (num_days x num_stocks) with dtype float64, so row |day| is the
+    allocation for the end of that day. After the .npy header (which records the shape), every day
+    takes exactly num_stocks * 8 bytes, so any day is read by seeking directly to
+    header_len + day * num_stocks * 8, no matter how long the history is.
+
+"""
+
+import numpy as np
+
+
+class AllocationWriter(object):
+    """
+    Writes daily allocations into a preallocated allocation file, 1 day at a time or in blocks.
+    """
+
+    def __init__(self, path, num_stocks, num_days):
+        self.path = path
+        self.allocations = np.lib.format.open_memmap(path, mode='w+', dtype=np.float64,
+                                                     shape=(num_days, num_stocks))
+
+    def write(self, day, allocation):
+        self.allocations[day, :] = allocation
+
+    def write_block(self, first_day, allocations):
+        """
+        :param allocations: (num_stocks x k) array with the allocations of days first_day, ..., first_day+k-1
+        """
+        self.allocations[first_day:first_day + allocations.shape[1], :] = allocations.T
+
+    def close(self):
+        self.allocations.flush()
+        del self.allocations
+
+
+class AllocationReader(object):
+    """
+    Constant time random access to the days of an allocation file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.allocations = np.load(path, mmap_mode='r')
+        self.num_days, self.num_stocks = self.allocations.shape
+
+    def get_allocation(self, day):
+        """
+        :return: The allocation for the end of |day| (copied out of the file)
+        """
+        if not 0 <= day < self.num_days:
+            raise IndexError('Day ' + str(day) + ' is not in allocation file ' + self.path)
+        return np.array(self.allocations[day, :])
+
+
+def save_allocations(path, b_history, block_len=256):
+    """
+    Write the daily allocations of a run to an allocation file.
+
+    :param b_history: (num_stocks x num_days+1) history of allocations that includes the final allocation
+    (as written to b_history.npy by Portfolio.save_results). Column 0 is the empty portfolio before the first
+    day, so the allocation for the end of day d is column d+1. May be a memory map; it's copied in blocks.
+    """
+    num_stocks, num_cols = b_history.shape
+    writer = AllocationWriter(path, num_stocks, num_cols - 1)
+    for first_day in range(0, num_cols - 1, block_len):
+        last_day = min(first_day + block_len, num_cols - 1)
+        writer.write_block(first_day, np.asarray(b_history[:, first_day+1:last_day+1]))
+    writer.close()
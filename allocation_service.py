@@ -0,0 +1,142 @@
+"""
+    Long-lived allocation service for live trading.
+
+    The service keeps a warm portfolio (e.g. an ExpertPool restored from training results
+    or from a checkpoint) in memory. Each request supplies one new day of prices, the service
+    advances the portfolio by that day with Portfolio.update and returns the new allocation,
+    so no data is reloaded and no history is replayed.
+
+    The service can be used in-process (AllocationService.allocate) or over a Unix socket
+    (AllocationService.serve), which takes 1 JSON request per line:
+        {"prices": {"op": [...], "cl": [...], "vol": [...], "lo": [...], "hi": [...]}}
+        {"day": 12}   (prices for day 12 are already in the service's MarketData)
+        {"cmd": "latency"}
+    and answers each one with a JSON line.
+
+"""
+
+import json
+import os
+import SocketServer
+from timeit import default_timer
+import numpy as np
+from portfolio import Portfolio
+
+
+class AllocationService(object):
+
+    def __init__(self, portfolio):
+        """
+        :param portfolio: The portfolio that makes the decisions (Portfolio object). Its market data must
+        have rows for the days that will be served (see MarketData.reserve_days).
+        """
+        if not isinstance(portfolio, Portfolio):
+            raise Exception('portfolio input to AllocationService constructor must be a Portfolio object.')
+
+        self.portfolio = portfolio
+        self.data = portfolio.data
+        if portfolio.last_day is None:
+            self.next_day = portfolio.start
+        else:
+            self.next_day = portfolio.last_day + 1
+        self.latencies = []  # Seconds spent on each request
+
+    @classmethod
+    def from_checkpoint(cls, portfolio, checkpoint_path):
+        """
+        Create a service for |portfolio| after restoring its state from a checkpoint (see Portfolio.save_checkpoint).
+        """
+        portfolio.load_checkpoint(checkpoint_path)
+        return cls(portfolio)
+
+    def allocate(self, day=None, prices=None):
+        """
+        Advance the portfolio by 1 day and return its allocation for the end of that day.
+
+        :param day: Day to serve (defaults to the day after the last one served). Days must be served in order.
+        :param prices: Optional dictionary of the day's prices with keys 'op' and 'cl' (and optionally
+        'vol', 'lo' and 'hi'). If omitted, the prices must already be in the portfolio's MarketData.
+        :return: The allocation (fraction of wealth in each stock)
+        """
+        start_time = default_timer()
+
+        if day is None:
+            day = self.next_day
+        if day != self.next_day:
+            raise Exception('AllocationService expected day ' + str(self.next_day) + ' but got day ' + str(day))
+        if prices is not None:
+            self.data.set_day(day, **prices)
+
+        self.portfolio.update(day, init=(day == self.portfolio.start))
+        self.next_day = day + 1
+        allocation = self.portfolio.get_b()
+
+        self.latencies.append(default_timer() - start_time)
+        return allocation
+
+    def latency_report(self):
+        """
+        :return: Dictionary summarizing the per-request latency in milliseconds
+        """
+        if len(self.latencies) == 0:
+            return {'num_requests': 0}
+
+        latencies_ms = 1000.0 * np.array(self.latencies)
+        return {
+            'num_requests': len(latencies_ms),
+            'p50_ms': float(np.percentile(latencies_ms, 50)),
+            'p99_ms': float(np.percentile(latencies_ms, 99)),
+            'mean_ms': float(np.mean(latencies_ms)),
+            'max_ms': float(np.max(latencies_ms)),
+        }
+
+    def print_latency_report(self):
+        report = self.latency_report()
+        print 'Served ', report['num_requests'], ' requests'
+        if report['num_requests'] > 0:
+            print 'Latency p50: %.3f ms, p99: %.3f ms' % (report['p50_ms'], report['p99_ms'])
+
+    def handle_request(self, request):
+        """
+        :param request: Decoded JSON request (see the module docstring)
+        :return: Response dictionary
+        """
+        if request.get('cmd') == 'latency':
+            return self.latency_report()
+
+        day = request.get('day')
+        allocation = self.allocate(day=day, prices=request.get('prices'))
+        return {
+            'day': self.next_day - 1,
+            'allocation': np.asarray(allocation).tolist(),
+            'latency_ms': 1000.0 * self.latencies[-1],
+        }
+
+    def serve(self, socket_path):
+        """
+        Serve requests over a Unix socket at |socket_path| until interrupted.
+        """
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        service = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    try:
+                        response = service.handle_request(json.loads(line))
+                    except Exception as e:
+                        response = {'error': str(e)}
+                    self.wfile.write(json.dumps(response) + '\n')
+                    self.wfile.flush()
+
+        server = SocketServer.UnixStreamServer(socket_path, RequestHandler)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(socket_path)
+            self.print_latency_report()
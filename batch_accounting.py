@@ -0,0 +1,237 @@
+import numpy as np
+
+import util
+from constants import init_dollars
+from market_data import MarketData
+
+
+class AccountingStep(object):
+    """
+    The daily accounting of Portfolio.update_dollars, shared by every place that simulates portfolios: let the
+    values held in each stock grow over the day (grow), then rebalance them to a target allocation at the
+    close (rebalance). Works on a single portfolio (|shape| = num_stocks) or on a batch of portfolios (one per
+    row of a num_portfolios x num_stocks matrix). All of the work happens in buffers allocated once, so a step
+    doesn't create any new arrays of the size of the values.
+    """
+
+    def __init__(self, shape):
+        self.growth = np.zeros(shape)
+        self.revenue = np.zeros(shape)
+        self.nan_mask = np.zeros(shape, dtype=bool)
+        self.active_value = np.zeros(shape)
+        self.active_b = np.zeros(shape)
+        self.work = np.zeros(shape)
+
+    @property
+    def nbytes(self):
+        return (self.growth.nbytes + self.revenue.nbytes + self.nan_mask.nbytes + self.active_value.nbytes +
+                self.active_b.nbytes + self.work.nbytes)
+
+    def grow(self, value, cl, last_close_price, is_active):
+        """
+        Let |value| (updated in place) grow from |last_close_price| to the closing prices |cl|. Stocks that can't
+        be traded today, or don't have a closing price yet, don't grow.
+
+        :param value: Dollars held in each stock (in the shape of this step)
+        :param cl: Closing price of each stock today
+        :param last_close_price: Last closing price of each stock (of every portfolio, or 1 row per portfolio)
+        :param is_active: Boolean array, True for the stocks that can be traded today
+        :return: Revenue of the portfolio over the day (an array with 1 entry per portfolio for a batch)
+        """
+        growth = self.growth
+        growth.fill(0)
+        np.divide(cl, last_close_price, out=growth, where=is_active)
+        np.subtract(growth, 1, out=growth, where=is_active)
+        np.isnan(growth, out=self.nan_mask)
+        np.copyto(growth, 0, where=self.nan_mask)
+        np.multiply(value, growth, out=self.revenue)
+        np.add(value, self.revenue, out=value)
+        return self.revenue.sum(axis=-1)
+
+    def rebalance(self, value, dollars_cl, is_active, is_inactive, target_b):
+        """
+        Rebalance |value| (updated in place) to the allocation |target_b| at the close, paying the transaction
+        costs. Money held in stocks that can't be traded today stays where it is.
+
+        :param dollars_cl: Dollars held at the close, before rebalancing (1 entry per portfolio for a batch)
+        :return: Transaction cost (1 entry per portfolio for a batch)
+        """
+        work = self.work
+        work.fill(0)
+        np.copyto(work, value, where=is_inactive)
+        value_realizable = dollars_cl - work.sum(axis=-1)
+
+        active_value = self.active_value
+        active_b = self.active_b
+        active_value.fill(0)
+        active_b.fill(0)
+        np.copyto(active_value, value, where=is_active)
+        np.copyto(active_b, target_b, where=is_active)
+        trans_cost = util.rebalance_in_place(active_value, value_realizable, active_b, work)
+        np.copyto(value, active_value, where=is_active)
+        return trans_cost
+
+
+class BatchAccounting(object):
+    """
+    Accounting engine that advances many portfolios trading on the same market data at once.
+
+    Each portfolio is a row of a (num_portfolios x num_stocks) matrix, so a single call to
+    update_dollars computes the close/open dollars, transaction costs and realized allocations
+    of every portfolio for one day. The accounting is the same as Portfolio.update_dollars (both
+    use AccountingStep).
+    """
+
+    def __init__(self, market_data, num_portfolios, start=0, stop=None, init_dollars=init_dollars,
+                 save_b_history=True):
+        """
+        :param market_data: Stock market data (MarketData object)
+        :param num_portfolios: Number of portfolios to simulate together.
+        :param start: What day the portfolios start at.
+        :param stop: Day after the last day to simulate (defaults to the end of the market data).
+        :param init_dollars: Dollars held by each portfolio at the open of the 1st day.
+        :param save_b_history: If False, only keep the current realized allocation of each portfolio
+        (saves num_portfolios x num_stocks x num_days floats).
+        """
+
+        if not isinstance(market_data, MarketData):
+            raise Exception('market_data input to BatchAccounting constructor must be a MarketData object.')
+
+        self.data = market_data
+        self.num_portfolios = num_portfolios
+        self.num_stocks = len(self.data.stock_names)
+        self.start = start
+
+        if stop:
+            self.stop = stop
+        else:
+            self.stop = self.data.get_vol().shape[0]
+        self.num_days = self.stop - self.start
+
+        self.b = np.zeros((num_portfolios, self.num_stocks))  # realized allocation at the open of the current day
+        if save_b_history:
+            self.b_history = np.zeros((num_portfolios, self.num_stocks, self.num_days))
+        else:
+            self.b_history = None
+        self.dollars_op_history = np.zeros((num_portfolios, self.num_days))
+        self.dollars_op_history[:, 0] = init_dollars
+        self.dollars_cl_history = np.zeros((num_portfolios, self.num_days))
+        self.trans_cost_history = np.zeros((num_portfolios, self.num_days))
+        self.last_close_price = np.NaN * np.ones(self.num_stocks)  # Shared, since all portfolios see the same market
+        self.value_mat = np.zeros((num_portfolios, self.num_stocks))
+        self.accounting = AccountingStep((num_portfolios, self.num_stocks))
+
+    def update_dollars(self, cur_day, target_b):
+        """
+        Let every portfolio's holdings grow over |cur_day|, then rebalance each portfolio to its
+        row of |target_b| at the close.
+
+        :param cur_day: 0-based index of today's date
+        :param target_b: (num_portfolios x num_stocks) desired allocations for the end of |cur_day|
+        :return: None
+        """
+
+        day_idx = cur_day - self.start
+
+        cl = self.data.get_cl(relative=False)[cur_day, :]
+        is_active = self.data.get_active()[cur_day, :]
+
+        # Value of each portfolio at the end of Day t before paying transaction costs
+        value_mat = self.value_mat
+        np.multiply(self.b, self.dollars_op_history[:, day_idx, np.newaxis], out=value_mat)
+        revenue = self.accounting.grow(value_mat, cl, self.last_close_price, is_active)
+        self.dollars_cl_history[:, day_idx] = self.dollars_op_history[:, day_idx] + revenue
+
+        # Rebalance every portfolio to its target allocation at the close of Day t
+        if day_idx <= self.num_days-2:
+            trans_cost = self.accounting.rebalance(value_mat, self.dollars_cl_history[:, day_idx], is_active,
+                                                   self.data.get_inactive()[cur_day, :], target_b)
+            self.trans_cost_history[:, day_idx] = trans_cost
+            self.dollars_op_history[:, day_idx+1] = self.dollars_cl_history[:, day_idx] - trans_cost
+            self.b = value_mat / self.dollars_op_history[:, day_idx+1, np.newaxis]
+            if self.b_history is not None:
+                self.b_history[:, :, day_idx+1] = self.b
+
+        np.copyto(self.last_close_price, cl, where=is_active)
+        return
+
+    def run(self, get_target_b, start=None, stop=None):
+        """
+        :param get_target_b: Function mapping a day to the (num_portfolios x num_stocks) target
+        allocations for the end of that day.
+        :param start:
+        :param stop:
+        :return: (num_portfolios x num_days) array of dollars held at the open of each day
+        """
+
+        if start is None:
+            start = self.start
+        if stop is None:
+            stop = self.stop
+
+        for day in range(start, stop):
+            self.update_dollars(day, get_target_b(day))
+        return self.dollars_op_history
+
+    def get_sharpe_ratios(self):
+        """
+        :return: Empirical Sharpe ratio of each portfolio (computed like util.empirical_sharpe_ratio)
+        """
+        return_mat = np.log(self.dollars_op_history[:, 1:] / self.dollars_op_history[:, :-1])
+        return np.sqrt(252) * np.mean(return_mat, axis=1) / np.std(return_mat, axis=1)
+
+    """
+    Getters
+    """
+    def get_b(self):
+        return self.b
+
+    def get_dollars_history(self):
+        return self.dollars_op_history
+
+
+def hold_portfolios(portfolios, stop):
+    """
+    Advance each of |portfolios| through the days before |stop| that it hasn't simulated yet, keeping its
+    current allocation. This is the same as calling Portfolio.hold on every missed day of every portfolio,
+    but each day is a single batched update of all the portfolios that are behind (see
+    ExpertPool.enable_dormancy). The portfolios must trade on the same market data.
+
+    :param portfolios: List of Portfolio objects that have been simulated for at least 1 day
+    :param stop: Day after the last day to simulate
+    :return: None
+    """
+    if len(portfolios) == 0:
+        return
+
+    data = portfolios[0].data
+    first_day = min(portfolio.last_day for portfolio in portfolios) + 1
+    for cur_day in range(first_day, stop):
+        behind = [portfolio for portfolio in portfolios if portfolio.last_day < cur_day]
+        day_idx = [cur_day - portfolio.start for portfolio in behind]
+
+        cl = data.get_cl(relative=False)[cur_day, :]
+        is_active = data.get_active()[cur_day, :]
+        accounting = AccountingStep((len(behind), data.get_cl().shape[1]))
+
+        # Value of each portfolio at the end of Day t before paying transaction costs
+        dollars_op = np.array([portfolio.dollars_op_history[idx] for (portfolio, idx) in zip(behind, day_idx)])
+        value_mat = np.array([portfolio.b_history[:, idx] for (portfolio, idx) in zip(behind, day_idx)])
+        value_mat *= dollars_op[:, np.newaxis]
+        last_close_price = np.array([portfolio.last_close_price for portfolio in behind])
+        dollars_cl = dollars_op + accounting.grow(value_mat, cl, last_close_price, is_active)
+
+        # Rebalance every portfolio to its current allocation at the close of Day t
+        target_b = np.array([portfolio.b for portfolio in behind])
+        trans_cost = accounting.rebalance(value_mat, dollars_cl, is_active, data.get_inactive()[cur_day, :], target_b)
+        dollars_op_next = dollars_cl - trans_cost
+        b_next = value_mat / dollars_op_next[:, np.newaxis]
+
+        for (i, portfolio) in enumerate(behind):
+            idx = day_idx[i]
+            portfolio.dollars_cl_history[idx] = dollars_cl[i]
+            if idx <= portfolio.num_days-2:
+                portfolio.dollars_op_history[idx+1] = dollars_op_next[i]
+                portfolio.b_history[:, idx+1] = b_next[i]
+            np.copyto(portfolio.last_close_price, cl, where=is_active)
+            portfolio.last_day = cur_day
@@ -0,0 +1,185 @@
+"""
+    Scaling benchmark of every strategy on synthetic markets.
+
+    Times each strategy (and tuning mode) on a grid of market sizes generated by
+    synthetic_market.generate_market_data, prints the results next to the previous
+    benchmark run and appends them to a JSON history file, so that regressions are visible.
+
+    Usage:
+        python benchmark.py --stocks 25,100,497 --days 60,250 --strategies OLMAR,RMR
+
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from timeit import default_timer
+import numpy as np
+from expert_pool import ExpertPool
+from olmar import OLMAR
+from rmr import RMR
+from synthetic_market import generate_market_data
+from ubah import UniformBuyAndHoldPortfolio
+from ucrp import UniformConstantRebalancedPortfolio
+
+default_history_path = 'results/benchmark_history.json'
+
+# Smaller hyperparameter grid for the tuned strategies so that the benchmark finishes in reasonable time
+bench_window_range = range(5, 30, 6)
+bench_eps_range = np.arange(1.1, 5.1, 0.8)
+
+
+def make_npm(market_data, tune_interval):
+    # Imported here because NPM needs cvxpy, which is optional for the other strategies
+    from nonparametric_markowitz import NonParametricMarkowitz
+    return NonParametricMarkowitz(market_data=market_data, window_len=10, k=10, risk_aversion=1e-5, start_date=25)
+
+
+def make_expert_pool(market_data, tune_interval):
+    experts = [OLMAR(market_data=market_data, tune_interval=tune_interval, window_range=bench_window_range,
+                     eps_range=bench_eps_range, silent=True),
+               RMR(market_data=market_data, tune_interval=tune_interval, window_range=bench_window_range,
+                   eps_range=bench_eps_range, silent=True)]
+    return ExpertPool(market_data=market_data, experts=experts, silent=True)
+
+# Strategy name -> (function(market_data, tune_interval) creating the portfolio, whether it can be tuned)
+strategies = {
+    'UCRP': (lambda data, tune_interval: UniformConstantRebalancedPortfolio(market_data=data, silent=True), False),
+    'UBAH': (lambda data, tune_interval: UniformBuyAndHoldPortfolio(market_data=data, silent=True), False),
+    'OLMAR': (lambda data, tune_interval: OLMAR(market_data=data, tune_interval=tune_interval, silent=True,
+                                                window_range=bench_window_range, eps_range=bench_eps_range), True),
+    'RMR': (lambda data, tune_interval: RMR(market_data=data, tune_interval=tune_interval, silent=True,
+                                            window_range=bench_window_range, eps_range=bench_eps_range), True),
+    'NPM': (make_npm, False),
+    'EP': (make_expert_pool, True),
+}
+
+
+def benchmark_strategy(name, market_data, tune_interval=None):
+    """
+    :return: Dictionary with the wall time of the run and the resulting performance
+    """
+    make_portfolio, _ = strategies[name]
+    try:
+        portfolio = make_portfolio(market_data, tune_interval)
+    except ImportError as e:
+        return {'skipped': str(e)}
+
+    start_time = default_timer()
+    portfolio.run()
+    seconds = default_timer() - start_time
+
+    return {
+        'seconds': seconds,
+        'ms_per_day': 1000.0 * seconds / portfolio.num_days,
+        'sharpe': float(portfolio.sharpe),
+        'final_dollars': float(portfolio.dollars_op_history[-1]),
+    }
+
+
+def run_benchmarks(stocks_grid, days_grid, strategy_names, tune_interval, seed=0):
+    results = []
+    for num_stocks in stocks_grid:
+        for num_days in days_grid:
+            market_data = generate_market_data(num_stocks=num_stocks, num_days=num_days, seed=seed)
+            for name in strategy_names:
+                tune_modes = [None]
+                if strategies[name][1] and tune_interval:
+                    tune_modes.append(tune_interval)
+                for cur_tune_interval in tune_modes:
+                    result = {
+                        'strategy': name,
+                        'tune_interval': cur_tune_interval,
+                        'num_stocks': num_stocks,
+                        'num_days': num_days,
+                        'seed': seed,
+                    }
+                    result.update(benchmark_strategy(name, market_data, cur_tune_interval))
+                    results.append(result)
+    return results
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(history_path):
+    if not os.path.exists(history_path):
+        return []
+    history_file = open(history_path)
+    history = json.load(history_file)
+    history_file.close()
+    return history
+
+
+def save_history(history_path, history):
+    history_dir = os.path.dirname(history_path)
+    if history_dir and not os.path.exists(history_dir):
+        os.makedirs(history_dir)
+    history_file = open(history_path, 'w')
+    json.dump(history, history_file, indent=2, sort_keys=True)
+    history_file.close()
+
+
+def result_key(result):
+    return (result['strategy'], result['tune_interval'], result['num_stocks'], result['num_days'], result['seed'])
+
+
+def print_results(results, prev_results):
+    prev_seconds = dict((result_key(res), res['seconds']) for res in prev_results if 'seconds' in res)
+
+    print '%-6s %6s %7s %6s %10s %10s %8s %9s' % ('Strat', 'Tune', 'Stocks', 'Days', 'Seconds', 'ms/day', 'Sharpe',
+                                                  'vs. prev')
+    for res in results:
+        if 'skipped' in res:
+            print '%-6s skipped (%s)' % (res['strategy'], res['skipped'])
+            continue
+        key = result_key(res)
+        ratio = ''
+        if key in prev_seconds and prev_seconds[key] > 0:
+            ratio = '%.2fx' % (res['seconds'] / prev_seconds[key])
+        print '%-6s %6s %7d %6d %10.3f %10.3f %8.3f %9s' % (res['strategy'], res['tune_interval'], res['num_stocks'],
+                                                            res['num_days'], res['seconds'], res['ms_per_day'],
+                                                            res['sharpe'], ratio)
+
+
+def parse_int_list(arg):
+    return [int(val) for val in arg.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the portfolio strategies on synthetic markets.')
+    parser.add_argument('--stocks', type=parse_int_list, default=[25, 100, 497], help='Comma separated # of stocks')
+    parser.add_argument('--days', type=parse_int_list, default=[60, 250], help='Comma separated # of days')
+    parser.add_argument('--strategies', default=','.join(sorted(strategies.keys())),
+                        help='Comma separated strategies to run')
+    parser.add_argument('--tune-interval', type=int, default=20,
+                        help='Tuning interval for the tuned runs of tunable strategies (0 to disable)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic market')
+    parser.add_argument('--history', default=default_history_path, help='JSON file to append the results to')
+    args = parser.parse_args()
+
+    strategy_names = args.strategies.split(',')
+    for name in strategy_names:
+        if name not in strategies:
+            raise Exception('Unknown strategy ' + name + '. Strategies: ' + ', '.join(sorted(strategies.keys())))
+
+    history = load_history(args.history)
+    prev_results = history[-1]['results'] if history else []
+
+    results = run_benchmarks(args.stocks, args.days, strategy_names, args.tune_interval, seed=args.seed)
+    print_results(results, prev_results)
+
+    history.append({
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'git_commit': get_git_commit(),
+        'python': platform.python_version(),
+        'results': results,
+    })
+    save_history(args.history, history)
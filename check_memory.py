@@ -0,0 +1,157 @@
+"""
+    Memory checks of the daily accounting.
+
+    Replays a UCRP portfolio on a synthetic market and checks that Portfolio.update_dollars doesn't
+    allocate any arrays on steady-state days (it only works in the buffers from init_work_buffers),
+    and checks that memory_usage counts streamed histories and the statistics of an ExpertPool by
+    what they keep in memory. Exits with status 1 if a check fails. regression.py runs the same
+    checks as part of the gate.
+
+    The allocations are measured with tracemalloc if it's available (Python 3), and otherwise by
+    the pages of memory each call touches for the first time after the heap is trimmed (glibc). On
+    other platforms the allocation check is skipped with a warning.
+
+    Usage:
+        python check_memory.py
+
+"""
+
+import resource
+import shutil
+import sys
+import tempfile
+from expert_pool import ExpertPool
+from profiling import minor_page_faults, trim_heap, tracemalloc
+from synthetic_market import generate_market_data
+from ubah import UniformBuyAndHoldPortfolio
+from ucrp import UniformConstantRebalancedPortfolio
+
+
+def traced_peak_bytes(func, *args):
+    """
+    :return: Peak memory allocated while calling func(*args), traced with tracemalloc
+    """
+    tracemalloc.start()
+    func(*args)
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak_bytes
+
+
+def paged_in_bytes(func, *args):
+    """
+    :return: Bytes of memory paged in by calling func(*args). The heap is trimmed first, so every page of an array
+    the call allocates is paged in (whether malloc reuses a freed block or maps new memory).
+    """
+    trim_heap()
+    faults_before = minor_page_faults()
+    func(*args)
+    return resource.getpagesize() * (minor_page_faults() - faults_before)
+
+
+def get_allocation_measure():
+    """
+    :return: traced_peak_bytes or paged_in_bytes, or None if neither works here
+    """
+    if tracemalloc is not None:
+        return traced_peak_bytes
+    if trim_heap():
+        return paged_in_bytes
+    return None
+
+
+def check_update_dollars(measure, num_stocks=20000, num_days=30, warmup_days=5):
+    """
+    Measure the memory allocated by each call of update_dollars after the first |warmup_days| days. A call
+    fails the check if it allocates half a byte per stock: even a boolean mask over the stocks is twice that,
+    while the few scalars and frames of a call take a fixed ~2 KB (at most a page or two).
+
+    :param measure: traced_peak_bytes or paged_in_bytes (see get_allocation_measure)
+    :return: List of failure messages
+    """
+    market_data = generate_market_data(num_stocks=num_stocks, num_days=num_days, seed=0)
+    portfolio = UniformConstantRebalancedPortfolio(market_data=market_data, silent=True)
+    max_bytes = num_stocks // 2
+
+    failures = []
+    for cur_day in range(portfolio.start, portfolio.stop):
+        portfolio.update_allocation(cur_day, init=(cur_day == portfolio.start))
+        if cur_day - portfolio.start < warmup_days:
+            portfolio.update_dollars(cur_day)
+            continue
+
+        peak_bytes = measure(portfolio.update_dollars, cur_day)
+        if peak_bytes >= max_bytes:
+            failures.append('update_dollars allocated %d bytes on day %d (max %d)' % (peak_bytes, cur_day,
+                                                                                     max_bytes))
+    return failures
+
+
+def check_memory_usage(num_stocks=200, num_days=500, chunk_len=64):
+    """
+    Run an ExpertPool of experts that stream their allocation histories to disk, with memory tracking, and
+    check the memory_usage in its summary.
+
+    :return: List of failure messages
+    """
+    market_data = generate_market_data(num_stocks=num_stocks, num_days=num_days, seed=0)
+    experts = [UniformConstantRebalancedPortfolio(market_data=market_data, silent=True),
+               UniformBuyAndHoldPortfolio(market_data=market_data, silent=True)]
+    store_dir = tempfile.mkdtemp() + '/'
+    try:
+        for (i, expert) in enumerate(experts):
+            expert.enable_streaming(store_dir + 'expert' + str(i) + '/', chunk_len=chunk_len)
+        pool = ExpertPool(market_data=market_data, experts=experts, silent=True)
+        pool.enable_memory_tracking()
+        pool.run()
+        usage = pool.memory_summary['usage']
+        expert_usages = [expert.memory_usage() for expert in experts]
+    finally:
+        shutil.rmtree(store_dir)
+
+    failures = []
+    dense_bytes = num_stocks * pool.num_days * 8  # Size of a b_history that isn't streamed
+    for (expert, expert_usage) in zip(experts, expert_usages):
+        if expert_usage['history'] >= dense_bytes:
+            failures.append('%s counts %d bytes of history, but only streams %d days of it in memory'
+                            % (expert.portfolio_type, expert_usage['history'], expert.b_history.tail_len))
+    if usage['children'] != sum(expert_usage['total'] for expert_usage in expert_usages):
+        failures.append('ExpertPool counts %d bytes of experts, but they hold %d'
+                        % (usage['children'], sum(expert_usage['total'] for expert_usage in expert_usages)))
+    if pool.rolling_sharpe is None or usage['stats'] != pool.rolling_sharpe.nbytes:
+        failures.append('ExpertPool counts %d bytes of statistics instead of its RollingSharpe' % usage['stats'])
+    return failures
+
+
+def run_checks():
+    """
+    :return: (failures, warnings): dictionaries mapping check names to lists of failure messages, and to
+    the reason the check wasn't run
+    """
+    failures = {}
+    warnings = {}
+    measure = get_allocation_measure()
+    if measure is None:
+        warnings['update_dollars_allocations'] = 'skipped: needs tracemalloc (Python 3) or glibc'
+    else:
+        failures['update_dollars_allocations'] = check_update_dollars(measure)
+    failures['streaming_memory_usage'] = check_memory_usage()
+
+    for name in sorted(failures):
+        print '%-26s %s' % (name, 'FAIL' if failures[name] else 'ok')
+        for failure in failures[name]:
+            print '    ' + failure
+    for name in sorted(warnings):
+        print '%-26s SKIP' % name
+    return failures, warnings
+
+
+if __name__ == "__main__":
+    failures, warnings = run_checks()
+    for name in sorted(warnings):
+        print 'WARNING: %s %s' % (name, warnings[name])
+    num_failed = len([name for name in failures if failures[name]])
+    if num_failed:
+        print num_failed, 'of', len(failures), 'memory checks failed'
+        sys.exit(1)
+    print 'All', len(failures), 'memory checks passed'
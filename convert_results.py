@@ -0,0 +1,46 @@
+"""
+    Convert results directories saved in the old tab-delimited text format
+    (dollars_history.txt, b_history.txt, hyperparams.txt) to the binary format
+    written by util.save_binary_results, so that they can be memory mapped.
+
+    Usage: python convert_results.py [results_root ...]
+    (Defaults to train_results/. Each subdirectory is assumed to hold the results of
+    the portfolio type it's named after, e.g. train_results/OLMAR/.)
+
+"""
+
+import os
+import sys
+import util
+
+
+def convert_results_dir(results_dir, portfolio_type):
+    """
+    :param results_dir: Path to a directory containing dollars_history.txt (must end in '/')
+    :param portfolio_type: Portfolio type to record in the metadata
+    :return: True if the directory was converted
+    """
+    if not os.path.exists(results_dir + 'dollars_history.txt'):
+        return False
+
+    b_history, dollars = util.load_text_results(results_dir)
+    hyperparams_dict = {}
+    if os.path.exists(results_dir + 'hyperparams.txt'):
+        hyperparams_dict = util.load_all_hyperparams(results_dir)
+
+    util.save_binary_results(save_dir=results_dir, portfolio_type=portfolio_type, dollars=dollars,
+                             b_history=b_history, hyperparams_dict=hyperparams_dict, start=0, stop=len(dollars))
+    return True
+
+
+def convert_results_root(results_root):
+    for name in sorted(os.listdir(results_root)):
+        results_dir = os.path.join(results_root, name) + '/'
+        if os.path.isdir(results_dir) and convert_results_dir(results_dir, portfolio_type=name):
+            print 'Converted ', results_dir
+
+
+if __name__ == "__main__":
+    roots = sys.argv[1:] if len(sys.argv) > 1 else ['train_results/']
+    for root in roots:
+        convert_results_root(root)
@@ -1,10 +1,17 @@
 import pdb
 from math import exp
+from timeit import default_timer
 import numpy as np
+import tracing
 import util
+from batch_accounting import hold_portfolios
 from constants import init_dollars
 from market_data import MarketData
+from parallel_experts import ExpertWorker
 from portfolio import Portfolio
+from profiling import array_nbytes
+from result_cache import hash_array
+from rolling_sharpe import RollingSharpe
 from util import predict_prices
 
 # TODO: throw error if some experts receive a history, but other experts don't
@@ -18,12 +25,16 @@ class ExpertPool(Portfolio):
     predicted stock prices at the end of the day). Then, we distribute
     money to each of the experts according to their predicted performance.
 
+    Pools can be nested (e.g. one sub-pool per algorithm family as the experts of
+    a top-level pool). With |hold_threshold|, experts and sub-pools with a low
+    weight only do the accounting until their weight recovers.
+
     """
 
     def __init__(self, market_data, experts, start=0, stop=None, init_weights=None,
                  rebal_interval=1, tune_interval=None,
                  init_b=None, init_dollars=init_dollars,
-                 weighting_strategy='exp_window', windows=[10], ew_alpha=0.5, ew_eta=0.8,
+                 weighting_strategy='exp_window', windows=[10], ew_alpha=0.5, ew_eta=0.8, hold_threshold=None,
                  verbose=False, silent=False, past_results_dir=None, new_results_dir=None, repeat_past=False):
 
         if not isinstance(market_data, MarketData):
@@ -49,6 +60,30 @@ class ExpertPool(Portfolio):
             self.windows = windows
         num_days = market_data.get_cl().shape[0]
         self.weights_history = np.zeros(shape=(num_days, self.num_experts))
+        self.rolling_sharpe = None  # RollingSharpe of the experts' dollar histories (created on first use)
+        self.init_expert_matrices()
+        self.parallel = False  # Step the experts in worker processes (see enable_parallel)
+        self.workers = None  # ExpertWorker of each expert while the workers are running
+        self.deadline = None  # Seconds the experts get each day before the pool answers (see enable_deadline)
+        self.tune_budget = None
+        self.tune_decay = None
+        self.deadline_misses = []  # (day, expert index, kind of miss) tuples
+        self.answer_latencies = []  # Seconds each day's update took until it returned (in deadline mode)
+        self.late_experts = []  # (expert index, day, init) of the deferred experts that still have to finish a day
+        self.num_tune_skips = np.zeros(self.num_experts, dtype=int)  # Tuning days skipped since each expert's last tuning
+
+        # Experts (e.g. sub-pools) whose weight on the previous day was below |hold_threshold| only do the
+        # accounting today (see Portfolio.hold), so that large ensembles spend compute where the weight is
+        self.hold_threshold = hold_threshold
+        self.num_held_days = np.zeros(self.num_experts, dtype=int)  # Days each expert was held
+
+        # Experts with negligible weights can also go dormant (see enable_dormancy)
+        self.dormant_threshold = None
+        self.wake_threshold = None
+        self.dormant = np.zeros(self.num_experts, dtype=bool)
+        self.num_dormant_days = np.zeros(self.num_experts, dtype=int)
+        self.num_wakeups = np.zeros(self.num_experts, dtype=int)
+        self.num_catch_ups = np.zeros(self.num_experts, dtype=int)  # Exact replays of each expert's dormant days
 
         # TODO: Check if past history was passed and load in hyperparams (see init of RMR and OLMAR for examples)
         # Note that this is only if we want to actually saw alpha and eta from training, which may be a good idea
@@ -62,26 +97,416 @@ class ExpertPool(Portfolio):
                                          init_b=init_b, tune_interval=tune_interval, verbose=verbose, silent=silent,
                                          past_results_dir=past_results_dir, new_results_dir=new_results_dir, repeat_past=repeat_past)
 
-    def aggregate_experts(self, weights):
-        net_b = np.zeros(self.num_stocks)  # weighted sum of expert allocations (must sum to 1)
+    def init_expert_matrices(self):
+        """
+        Keep the experts' allocations in a (num_experts x num_stocks) matrix and their dollar histories in a
+        (num_experts x num_days) matrix, so that aggregation and weighting are matrix operations.
+        The experts' dollar histories become views of the rows of the dollars matrix (each expert still
+        updates its own history in place). The allocation rows are copied from the experts after they update.
+        """
+        num_days = self.experts[0].num_days
+        for expert in self.experts:
+            if expert.num_days != num_days:
+                raise Exception('All experts in an ExpertPool must simulate the same number of days.')
+
+        self.expert_b = np.zeros((self.num_experts, self.experts[0].num_stocks))
+        self.expert_dollars = np.zeros((self.num_experts, num_days))
         for (idx, expert) in enumerate(self.experts):
-            net_b += np.multiply(weights[idx], expert.get_b())
+            self.expert_dollars[idx] = expert.dollars_op_history
+            expert.dollars_op_history = self.expert_dollars[idx]
+
+    def aggregate_experts(self, weights):
+        net_b = np.dot(weights, self.expert_b)  # weighted sum of expert allocations (must sum to 1)
 
         # Normalize so that b sums to 1 (positive and negative experts will have canceled each other out)
         sum_b = 1.0 * np.linalg.norm(net_b, ord=1)
         return np.true_divide(net_b, sum_b)
 
+    def update(self, cur_day, init=False, tune=True):
+        day_start = default_timer()
+        super(ExpertPool, self).update(cur_day, init, tune)
+        if self.deadline is not None:
+            # The caller gets control back here, so this includes all of the day's work
+            self.answer_latencies.append(default_timer() - day_start)
+
     def update_allocation(self, cur_day, init=False):
-        # Update the individual experts
-        for expert in self.experts:
-            expert.update(cur_day, init)
+        day_start = default_timer()
+
+        # Finish the previous day for the experts that missed its deadline, then update the individual
+        # experts. The ones that miss today's deadline (if any) use their previous allocations today.
+        self.catch_up_experts()
+        if self.parallel:
+            with tracing.span('experts_parallel', day=cur_day):
+                if self.timer is None:
+                    late_experts = self.update_experts_parallel(cur_day, init, day_start)
+                else:
+                    late_experts = self.timer.call('experts_parallel', cur_day, self.update_experts_parallel,
+                                                   cur_day, init, day_start)
+        else:
+            late_experts = self.update_experts(cur_day, init, day_start)
+
+        if self.dormant_threshold is not None:
+            self.estimate_dormant(cur_day)
 
         # Call the regular update_allocation method
         super(ExpertPool, self).update_allocation(cur_day=cur_day, init=init)
+
+        self.late_experts = [(idx, cur_day, init) for idx in late_experts]
         return
 
+    def update_expert(self, idx, cur_day, init=False):
+        expert = self.experts[idx]
+        if self.should_hold(idx, cur_day):
+            self.num_held_days[idx] += 1
+            step, args = expert.hold, (cur_day,)
+        else:
+            step, args = expert.update, (cur_day, init, self.allow_tuning(idx, cur_day))
+        with tracing.span('expert', expert=idx, day=cur_day):
+            if self.timer is None:
+                step(*args)
+            else:
+                self.timer.call('expert_' + str(idx), cur_day, step, *args)
+        self.expert_b[idx] = expert.get_b()
+
+    def should_hold(self, idx, cur_day):
+        """
+        An expert is held (see Portfolio.hold) if its weight on the previous day was below the hold threshold.
+        """
+        if self.hold_threshold is None or cur_day <= self.start or self.experts[idx].last_day is None:
+            return False
+        return self.weights_history[cur_day-1, idx] < self.hold_threshold
+
+    def hold(self, cur_day):
+        """
+        Hold the pool (e.g. as a sub-pool with a low weight in its parent pool): the experts are held as
+        well and the weights stay the same, so the whole subtree only does the accounting.
+        """
+        self.catch_up_experts()
+        if self.workers is not None:
+            for worker in self.workers:
+                worker.send_hold(cur_day)
+            for (idx, worker) in enumerate(self.workers):
+                self.expert_b[idx] = worker.receive_update(cur_day)
+        else:
+            for (idx, expert) in enumerate(self.experts):
+                if self.dormant[idx]:
+                    self.num_dormant_days[idx] += 1
+                    continue
+                expert.hold(cur_day)
+                self.expert_b[idx] = expert.get_b()
+            if self.dormant_threshold is not None:
+                self.estimate_dormant(cur_day)
+        self.weights_history[cur_day, :] = self.weights_history[cur_day-1, :]
+        super(ExpertPool, self).hold(cur_day)
+
+    def update_experts(self, cur_day, init, day_start):
+        """
+        Update the experts one after the other, except the dormant ones. In deadline mode, the experts that
+        haven't started when the deadline passes are deferred.
+
+        :return: Indices of the deferred experts
+        """
+        late_experts = []
+        for idx in range(self.num_experts):
+            if self.dormant[idx]:
+                self.num_dormant_days[idx] += 1
+                continue
+            if self.can_defer(idx) and default_timer() - day_start >= self.deadline:
+                late_experts.append(idx)
+                self.deadline_misses.append((cur_day, idx, 'deferred'))
+                continue
+            self.update_expert(idx, cur_day, init)
+            if self.deadline is not None and default_timer() - day_start > self.deadline:
+                self.deadline_misses.append((cur_day, idx, 'overran'))
+        return late_experts
+
+    def update_experts_parallel(self, cur_day, init, day_start):
+        """
+        Step every expert through |cur_day| in its worker process and wait until all of them are done
+        (or, in deadline mode, until the deadline passes).
+
+        :return: Indices of the experts that didn't finish before the deadline
+        """
+        if self.workers is None:
+            self.workers = [ExpertWorker(expert) for expert in self.experts]
+        for (idx, worker) in enumerate(self.workers):
+            if self.should_hold(idx, cur_day):
+                self.num_held_days[idx] += 1
+                worker.send_hold(cur_day)
+            else:
+                worker.send_update(cur_day, init, self.allow_tuning(idx, cur_day))
+
+        late_experts = []
+        for (idx, worker) in enumerate(self.workers):
+            if self.can_defer(idx):
+                remaining = self.deadline - (default_timer() - day_start)
+                if not worker.poll(max(remaining, 0)):
+                    late_experts.append(idx)
+                    self.deadline_misses.append((cur_day, idx, 'deferred'))
+                    continue
+            self.expert_b[idx] = worker.receive_update(cur_day)
+        return late_experts
+
+    def can_defer(self, idx):
+        """
+        In deadline mode, an expert can be deferred if it has a previous allocation to fall back on.
+        """
+        return self.deadline is not None and self.experts[idx].last_day is not None
+
+    def catch_up_experts(self):
+        """
+        Finish the day the deferred experts missed, so that their dollar histories are complete before the
+        pool uses them again. In parallel mode the workers kept running after the deadline, so this usually
+        only collects their replies.
+        """
+        for (idx, day, init) in self.late_experts:
+            if self.workers is not None:
+                self.expert_b[idx] = self.workers[idx].receive_update(day)
+            else:
+                self.update_expert(idx, day, init)
+        self.late_experts = []
+
+    def allow_tuning(self, idx, cur_day):
+        """
+        In deadline mode, an expert doesn't tune if its estimated tuning time is over the tuning budget. The
+        estimate is the time of its last tuning, scaled by |tune_decay| for each tuning day it skipped since,
+        so an expert that tuned slowly once tries again later (and its tuning time is measured again).
+        """
+        expert = self.experts[idx]
+        if self.deadline is None or not expert.is_tune_day(cur_day):
+            return True
+        if expert.last_tune_seconds is not None and \
+                expert.last_tune_seconds * self.tune_decay ** self.num_tune_skips[idx] > self.tune_budget:
+            self.num_tune_skips[idx] += 1
+            self.deadline_misses.append((cur_day, idx, 'tune_skipped'))
+            return False
+        self.num_tune_skips[idx] = 0
+        return True
+
+    def enable_deadline(self, deadline, tune_budget=None, tune_decay=0.5):
+        """
+        Answer within a time limit each day, so that the pool can meet a latency target in live trading.
+        Experts are never interrupted, but:
+            - Experts that haven't finished by the deadline (or, in sequential mode, haven't started) are
+              deferred: the pool uses their previous allocations today and they finish the day at the start
+              of the next day's update. Experts are never deferred on their first day.
+            - Experts skip tuning while their estimated tuning time is over |tune_budget| (see allow_tuning).
+        The latency of each day (until update returns, including the catch-up of the experts deferred the
+        day before) and the misses are recorded (see get_deadline_report).
+
+        The deadline only bounds the latency in parallel mode (see enable_parallel), where the pool stops
+        waiting for the experts at the deadline. In sequential mode an expert that started before the
+        deadline runs to the end of its update (recorded as 'overran'), and deferred experts are caught up
+        in this process at the start of the next day, which delays that day's experts.
+
+        :param deadline: Seconds from the start of the day's update until the pool's allocation is ready
+        :param tune_budget: Max seconds an expert may spend tuning (default: |deadline|)
+        :param tune_decay: Factor the tuning time estimate of an expert shrinks by on each tuning day it skips
+        """
+        self.deadline = deadline
+        self.tune_budget = deadline if tune_budget is None else tune_budget
+        self.tune_decay = tune_decay
+
+    def get_deadline_report(self):
+        """
+        :return: Dictionary with the pool's answer latencies (milliseconds) and the number of misses of
+        each kind ('deferred', 'overran', 'tune_skipped') for each expert
+        """
+        latencies_ms = 1000.0 * np.array(self.answer_latencies)
+        misses = [{} for _ in range(self.num_experts)]
+        for (day, idx, kind) in self.deadline_misses:
+            misses[idx][kind] = misses[idx].get(kind, 0) + 1
+        report = {
+            'deadline_ms': 1000.0 * self.deadline,
+            'tune_budget_ms': 1000.0 * self.tune_budget,
+            'num_days': len(latencies_ms),
+            'days_over_deadline': int(np.sum(latencies_ms > 1000.0 * self.deadline)),
+            'misses': misses,
+        }
+        if len(latencies_ms):
+            report['p50_ms'] = float(np.percentile(latencies_ms, 50))
+            report['p99_ms'] = float(np.percentile(latencies_ms, 99))
+            report['max_ms'] = float(np.max(latencies_ms))
+        return report
+
+    def enable_dormancy(self, threshold, wake_threshold=None):
+        """
+        Let experts with negligible weights go dormant: an expert whose weight falls below |threshold| skips
+        its daily updates (no tuning, no new allocations and no accounting). The pool weights dormant experts
+        by an estimate of their dollars (see estimate_dormant). Only when an estimated weight reaches
+        |wake_threshold|, i.e. when the expert could matter for the pool's allocation again, are its missed
+        days replayed exactly with its frozen allocation, in a single batched replay of the whole span (see
+        catch_up_dormant). It wakes up (resumes its full updates) if its weight still reaches |wake_threshold|
+        with the exact dollars. The dormant experts are also caught up at the end of the run. Use
+        get_dormancy_report to compare the result against the always-on pool. Not supported in parallel mode.
+
+        :param threshold: Weight below which an expert goes dormant
+        :param wake_threshold: Weight at which a dormant expert wakes up (default: |threshold|)
+        """
+        if self.parallel:
+            raise Exception('Dormant experts are not supported in parallel mode.')
+        self.dormant_threshold = threshold
+        self.wake_threshold = threshold if wake_threshold is None else wake_threshold
+
+    @staticmethod
+    def get_subtree(expert):
+        """
+        :return: List with |expert| and, if it's a pool, all of the portfolios nested in it
+        """
+        if not isinstance(expert, ExpertPool):
+            return [expert]
+        subtree = [expert]
+        for sub_expert in expert.experts:
+            subtree += ExpertPool.get_subtree(sub_expert)
+        return subtree
+
+    def estimate_dormant(self, cur_day):
+        """
+        Estimate the dollars of the dormant experts after |cur_day| as if they held their frozen allocations
+        without transaction costs: a single product of their allocations and today's returns (stocks without
+        a closing price relative don't grow). The estimates are written into the experts' dollar
+        histories until catch_up_dormant replaces them with the exact dollars.
+        """
+        day_idx = cur_day - self.start
+        dormant_idx = np.flatnonzero(self.dormant)
+        if len(dormant_idx) == 0 or day_idx > self.num_days-2:
+            return
+        price_rel = np.nan_to_num(self.data.get_cl()[cur_day, :])
+        price_rel[price_rel <= 0] = 1.0
+        # Same as the revenue in Portfolio.update_dollars (allocations may be long-short)
+        growth = 1 + np.dot(self.expert_b[dormant_idx], price_rel - 1)
+        self.expert_dollars[dormant_idx, day_idx+1] = self.expert_dollars[dormant_idx, day_idx] * growth
+
+    def catch_up_dormant(self, cur_day, catch_up):
+        """
+        Replay the days through |cur_day| that the dormant experts in |catch_up| (and everything nested in
+        them) missed, keeping their allocations (and the weights of dormant sub-pools) frozen. The whole span
+        is replayed in one batched call (see batch_accounting.hold_portfolios). The exact dollars replace the
+        estimates of estimate_dormant, so the running sums of the Sharpe ratios are rewound to the first
+        replayed day.
+
+        :param catch_up: Boolean mask of the experts to catch up
+        """
+        catch_up = np.logical_and(catch_up, self.dormant)
+        portfolios = []
+        for idx in np.flatnonzero(catch_up):
+            portfolios += ExpertPool.get_subtree(self.experts[idx])
+        portfolios = [portfolio for portfolio in portfolios if portfolio.last_day < cur_day]
+        if len(portfolios) == 0:
+            return
+        first_day = min(self.experts[idx].last_day for idx in np.flatnonzero(catch_up)) + 1
+        sub_pools = [(pool, pool.last_day) for pool in portfolios if isinstance(pool, ExpertPool)]
+        with tracing.span('catch_up_dormant', day=cur_day, num_portfolios=len(portfolios)):
+            if self.timer is None:
+                hold_portfolios(portfolios, cur_day + 1)
+            else:
+                self.timer.call('catch_up_dormant', cur_day, hold_portfolios, portfolios, cur_day + 1)
+        for (pool, last_day) in sub_pools:
+            pool.weights_history[last_day+1:cur_day+1, :] = pool.weights_history[last_day, :]
+        self.num_catch_ups += catch_up
+        if self.rolling_sharpe is not None:
+            # The dollars at the open of the day after |first_day| are the first ones that were estimated
+            self.rolling_sharpe.rewind(first_day + 1 - self.start)
+
+    def update_dormancy(self, cur_day, weights):
+        """
+        Put the experts whose |weights| are below the dormancy threshold to sleep and wake up the dormant
+        experts whose weights reached the wake threshold. The weights of the dormant experts come from
+        estimates, so the ones that could wake up are caught up first and all of the weights are computed
+        again (until no other dormant expert could wake up).
+
+        :return: The weights of the experts on |cur_day|
+        """
+        caught_up = np.zeros(self.num_experts, dtype=bool)
+        while True:
+            catch_up = self.dormant & (weights >= self.wake_threshold) & ~caught_up
+            if not np.any(catch_up):
+                break
+            self.catch_up_dormant(cur_day, catch_up)
+            caught_up |= catch_up
+            weights = self.get_weights(cur_day)
+
+        waking = np.logical_and(self.dormant, weights >= self.wake_threshold)
+        self.num_wakeups += waking
+        self.dormant = np.where(self.dormant, weights < self.wake_threshold, weights < self.dormant_threshold)
+        return weights
+
+    def get_dormancy_report(self, reference=None):
+        """
+        :param reference: The same pool run without dormant experts over the same days (optional)
+        :return: Dictionary with the number of dormant days, wake-ups and exact catch-ups of each expert, the
+        fraction of expert updates that were skipped and, given |reference|, how far the pool's results are
+        from the always-on pool's
+        """
+        num_days = 0 if self.last_day is None else self.last_day + 1 - self.start
+        report = {
+            'threshold': self.dormant_threshold,
+            'wake_threshold': self.wake_threshold,
+            'num_dormant_days': self.num_dormant_days.tolist(),
+            'num_wakeups': self.num_wakeups.tolist(),
+            'num_catch_ups': self.num_catch_ups.tolist(),
+            'skipped_fraction': float(np.sum(self.num_dormant_days)) / max(num_days * self.num_experts, 1),
+        }
+        if reference is not None:
+            days = slice(self.start, self.start + num_days)
+            dollars = self.dollars_op_history[:num_days]
+            ref_dollars = reference.dollars_op_history[:num_days]
+            report['final_dollars'] = float(dollars[-1])
+            report['reference_final_dollars'] = float(ref_dollars[-1])
+            report['max_rel_dollars_diff'] = float(np.max(np.abs(dollars - ref_dollars) / ref_dollars))
+            report['max_weight_diff'] = float(np.max(np.abs(self.weights_history[days] -
+                                                            reference.weights_history[days])))
+            report['sharpe'] = util.empirical_sharpe_ratio(dollars)
+            report['reference_sharpe'] = util.empirical_sharpe_ratio(ref_dollars)
+        return report
+
+    def enable_parallel(self):
+        """
+        Step each expert in its own worker process (see parallel_experts), so that a day takes about as long
+        as the slowest expert. The workers start on the first simulated day and stop at the end of the run,
+        when the experts' complete states are copied back. For live trading with MarketData.set_day, call
+        MarketData.share_memory before creating the experts.
+        """
+        if self.dormant_threshold is not None:
+            raise Exception('Dormant experts are not supported in parallel mode.')
+        self.parallel = True
+
+    def sync_experts(self):
+        """
+        Copy the complete state of each expert from its worker (if the workers are running).
+        """
+        self.catch_up_experts()
+        if self.workers is not None:
+            for worker in self.workers:
+                worker.sync_state()
+
+    def stop_workers(self):
+        if self.workers is not None:
+            self.sync_experts()
+            for worker in self.workers:
+                worker.stop()
+            self.workers = None
+
+    def finish_run(self):
+        self.catch_up_experts()
+        if self.dormant_threshold is not None and self.last_day is not None:
+            self.catch_up_dormant(self.last_day, self.dormant)
+        self.stop_workers()
+
     def get_new_allocation(self, cur_day, init=False):
-        if self.data_train is None and cur_day < 3:
+        weights = self.get_weights(cur_day)
+        if self.dormant_threshold is not None:
+            weights = self.update_dormancy(cur_day, weights)
+
+        net_b = self.aggregate_experts(weights)
+        self.weights_history[cur_day, :] = weights
+        return net_b
+
+    def get_weights(self, cur_day):
+        """
+        :return: Fraction of wealth we'll give to each expert for trading at the end of |cur_day|
+        """
+        if self.data_train is None and cur_day - self.start < 3:
             # Use uniform weights for all experts, since we have limited info
             # (Need at least 3 days of history to define sharpe ratio)
             weights = (1.0 / self.num_experts) * np.ones(self.num_experts)
@@ -92,10 +517,10 @@ class ExpertPool(Portfolio):
                 weights = self.ma_performance_weighting(cur_day)
             elif self.weighting_strategy == 'exp_window':
                 weights = self.recent_sharpe_weighting(cur_day)
-
-        net_b = self.aggregate_experts(weights)
-        self.weights_history[cur_day, :] = weights
-        return net_b
+            if not np.all(np.isfinite(weights)):
+                raise Exception('The ' + self.weighting_strategy + ' weights of the experts on day ' + str(cur_day) +
+                                ' are not finite: ' + str(weights))
+        return weights
 
     def open_price_weighting(self, cur_day):
         """
@@ -108,13 +533,10 @@ class ExpertPool(Portfolio):
         est_cl_rel = predict_prices(cur_day, self.data)  # Estimate closing price relatives
 
         # Predict return per dollar invested into each expert based on estimated prices
-        preds = []
-        for expert in self.experts:
-            expert.update_allocation(cur_day)
-            predicted_performance = expert.predict_performance(cur_day=cur_day, est_cl=est_cl_rel)
-            preds.append(predicted_performance)
+        # (the experts' allocations for today are already in expert_b)
+        preds = Portfolio.predict_performance(self.expert_b, est_cl_rel)
 
-        weights = np.multiply((1.0 / sum(preds)), preds)
+        weights = (1.0 / np.sum(preds)) * preds
         return weights
 
     def recent_sharpe_weighting(self, cur_day):
@@ -122,68 +544,58 @@ class ExpertPool(Portfolio):
         Compute weights of experts based on:
         (1/2)*exp(eta * SR_w1) + (/2)^2 * exp(eta * SR_w2) + ...
         where SR_wi is the empirical sharpe ratio of an expert in window i.
+        The Sharpe ratios come from running sums of the log returns (see RollingSharpe), so the cost per day
+        doesn't depend on the lengths of the windows. The exponents are shifted by the largest one, so that
+        exp can't overflow (the shift cancels out in the normalization).
 
         :param cur_day:
         :return:
         """
 
+        day_idx = cur_day - self.start  # The dollar histories (and RollingSharpe) start at self.start
         windows = self.windows
         len_windows = sum(windows)
 
-        if cur_day < len_windows:
+        if day_idx < len_windows:
             expert = self.experts[0]  # if 1 expert has history, then all of them should
             if expert.past_dollars_history is None:
                 # Not enough data to use all of the windows and no previous training data available.
-                windows = [cur_day]
+                windows = [day_idx]
 
         # Get the window ranges
         window_ranges = []  # list of (start, stop) tuples for each window
-        cur_stop = cur_day
+        cur_stop = day_idx
         for (i, window) in enumerate(windows):
             cur_start = cur_stop - windows[i]
             window_ranges.append((cur_start, cur_stop))
             cur_stop = cur_start
 
-        num_experts = self.num_experts
-        cum_sharpes = np.zeros(shape=(1, num_experts))  # sharpe ratios of each expert (summed over each window)
-
-        for i, expert in enumerate(self.experts):
-            exp_new_dollars_hist = expert.get_dollars_history()
-            exp_past_dollars_hist = None
-            if expert.past_dollars_history is not None:
-                # Get the expert's past history and normalize so that the history ends with the same amount
-                # of money that this ExpertPool started with
-                exp_past_dollars_hist = expert.past_dollars_history
-                final_past = exp_past_dollars_hist[-1]
-                exp_past_dollars_hist *= (1.0 * exp_new_dollars_hist[0]) / final_past
-
-            for w, (cur_start, cur_stop) in enumerate(window_ranges):
-                if cur_start < 0 and cur_stop <= 0:
-                    # Get window from the prior history
-                    if exp_past_dollars_hist is None:
-                        raise Exception('Invalid window from ' + str(cur_start) + ' to ' + str(cur_stop) +
-                                        ' for expert with no prior history available.')
-                    else:
-                        if cur_stop == 0:
-                            window_dollars = exp_past_dollars_hist[cur_start:]
-                        else:
-                            window_dollars = exp_past_dollars_hist[cur_start:cur_stop]
-                elif cur_start < 0 < cur_stop:
-                    # Get beginning of window from prior history and the rest from the new history
-                    window_dollars_past = exp_past_dollars_hist[cur_start:]
-                    window_dollars_new = exp_new_dollars_hist[:cur_stop]
-                    window_dollars = np.concatenate([window_dollars_past, window_dollars_new])
-                elif cur_start >= 0 and cur_stop > 0:
-                    # Get window from the new history
-                    window_dollars = exp_new_dollars_hist[cur_start:cur_stop]
-
-                # Perform Exponential Weighting and Scale Down Older Windows
-                scale = (1.0 * self.ew_alpha)**w
-                cum_sharpes[0, i] += scale * exp(self.ew_eta * util.empirical_sharpe_ratio(window_dollars))
+        if self.rolling_sharpe is None:
+            self.rolling_sharpe = self.make_rolling_sharpe()
+
+        exponents = [self.ew_eta * self.rolling_sharpe.get_sharpe_ratios(cur_start, cur_stop)
+                     for (cur_start, cur_stop) in window_ranges]
+        shift = np.max(exponents)
+
+        cum_sharpes = np.zeros(self.num_experts)  # sharpe ratios of each expert (summed over each window)
+        for w, exponent in enumerate(exponents):
+            # Perform Exponential Weighting and Scale Down Older Windows
+            scale = (1.0 * self.ew_alpha)**w
+            cum_sharpes += scale * np.exp(exponent - shift)
 
         # Normalize to obtain weights that sum to 1
         weights = (1.0 / np.sum(cum_sharpes)) * cum_sharpes
-        return weights[0]  # return the array as a single row
+        return weights
+
+    def make_rolling_sharpe(self):
+        """
+        Rolling Sharpe ratios of the experts' dollar histories. The experts' past histories (if any) come
+        before their new histories, so windows can reach back into the prior history.
+        """
+        past_histories = None
+        if self.experts[0].past_dollars_history is not None:
+            past_histories = [expert.past_dollars_history for expert in self.experts]
+        return RollingSharpe(self.expert_dollars, past_histories)
 
     def ma_performance_weighting(self, cur_day):
         """
@@ -192,24 +604,19 @@ class ExpertPool(Portfolio):
         :param cur_day: Current day
         :return: Fraction of wealth we'll give to each expert for trading at the end of |cur_day|
         """
+        day_idx = cur_day - self.start  # The dollar histories start at self.start
         window = self.windows[0]
-        if cur_day <= window:
+        if day_idx <= window:
             # Full window is not available
-            window = cur_day
-
-        ma_returns = np.zeros(shape=(1, self.num_experts))
-        for i, expert in enumerate(self.experts):
-            dollars_history = expert.get_dollars_history()
-            cur_dollars = dollars_history[-1]
-            window_dollars = dollars_history[-(window+1):cur_day]
+            window = day_idx
 
-            window_start_dollars = dollars_history[-(window+1)]
-            # Note: may want to convert these to relative returns
-            avg_return_per_day = (cur_dollars - window_start_dollars) * (1.0 / window)
-            ma_returns[0, i] = avg_return_per_day
+        # Note: may want to convert these to relative returns
+        cur_dollars = self.expert_dollars[:, day_idx]
+        window_start_dollars = self.expert_dollars[:, day_idx - window]
+        ma_returns = (cur_dollars - window_start_dollars) * (1.0 / window)  # Average return per day
 
         weights = (1.0 / sum(ma_returns)) * ma_returns  # Normalize to obtain weights
-        return weights[0]  # return the array as a single row
+        return weights
 
     def print_results(self):
         print 30 * '-'
@@ -226,6 +633,130 @@ class ExpertPool(Portfolio):
             if expert.new_results_dir is not None:
                 expert.save_results()
 
+    def enable_timing(self, timer=None):
+        """
+        Time the pool's phases, the total update time of each expert ('expert_i') and each expert's own phases.
+        """
+        super(ExpertPool, self).enable_timing(timer)
+        for expert in self.experts:
+            expert.enable_timing()
+
+    def get_timing_summary(self):
+        summary = super(ExpertPool, self).get_timing_summary()
+        summary['experts'] = [expert.get_timing_summary() for expert in self.experts]
+        if self.deadline is not None:
+            summary['deadline'] = self.get_deadline_report()
+        if self.hold_threshold is not None:
+            summary['num_held_days'] = self.num_held_days.tolist()
+        if self.dormant_threshold is not None:
+            summary['dormancy'] = self.get_dormancy_report()
+        return summary
+
+    def enable_memory_tracking(self, tracker=None):
+        """
+        Track the pool's memory deltas and those of each expert.
+        """
+        super(ExpertPool, self).enable_memory_tracking(tracker)
+        for expert in self.experts:
+            expert.enable_memory_tracking()
+
+    def memory_usage(self):
+        usage = super(ExpertPool, self).memory_usage()
+        # expert_dollars isn't counted, since its rows are the experts' own dollar histories
+        history_bytes = array_nbytes(self.weights_history, self.expert_b)
+        stats_bytes = array_nbytes(self.rolling_sharpe)
+        children_bytes = sum(expert.memory_usage()['total'] for expert in self.experts)
+        usage['history'] += history_bytes
+        usage['stats'] += stats_bytes
+        usage['children'] += children_bytes
+        usage['total'] += history_bytes + stats_bytes + children_bytes
+        return usage
+
+    def get_memory_summary(self):
+        summary = super(ExpertPool, self).get_memory_summary()
+        summary['experts'] = [expert.get_memory_summary() for expert in self.experts]
+        return summary
+
+    def enable_result_cache(self, cache, dollars_only=False):
+        """
+        Cache the pool's runs and pass the cache on to the experts (for the backtests they run while tuning).
+        """
+        super(ExpertPool, self).enable_result_cache(cache, dollars_only)
+        for expert in self.experts:
+            expert.enable_result_cache(cache)
+
+    def get_cache_params(self):
+        if self.deadline is not None:
+            return None  # The results depend on how long the experts take
+
+        params = super(ExpertPool, self).get_cache_params()
+        params['weighting_strategy'] = self.weighting_strategy
+        params['windows'] = getattr(self, 'windows', None)
+        params['ew_alpha'] = float(self.ew_alpha)
+        params['ew_eta'] = float(self.ew_eta)
+        params['hold_threshold'] = self.hold_threshold
+        params['dormant_threshold'] = self.dormant_threshold
+        params['wake_threshold'] = self.wake_threshold
+
+        params['experts'] = []
+        for expert in self.experts:
+            expert_params = expert.get_cache_params()
+            if expert_params is None:
+                return None
+            params['experts'].append({
+                'strategy': expert.__class__.__module__ + '.' + expert.__class__.__name__,
+                'params': expert_params,
+                'start': expert.start,
+                'stop': expert.stop,
+                'init_b': hash_array(expert.b),
+            })
+        return params
+
+    def enable_streaming(self, store_dir, tail_len=32, chunk_len=256):
+        """
+        Stream the allocation histories of the pool and of each expert (to store_dir/expert_i/).
+        """
+        super(ExpertPool, self).enable_streaming(store_dir, tail_len=tail_len, chunk_len=chunk_len)
+        for (idx, expert) in enumerate(self.experts):
+            expert.enable_streaming(store_dir + 'expert_' + str(idx) + '/', tail_len=tail_len, chunk_len=chunk_len)
+
+    def get_state(self):
+        """
+        State of the pool and of each of its experts. Expert i's entries are prefixed with 'expert_i.'
+        """
+        self.sync_experts()
+        state = super(ExpertPool, self).get_state()
+        state['weights_history'] = self.weights_history
+        state['num_held_days'] = self.num_held_days
+        state['dormant'] = self.dormant
+        state['num_dormant_days'] = self.num_dormant_days
+        state['num_wakeups'] = self.num_wakeups
+        state['num_catch_ups'] = self.num_catch_ups
+        state['num_tune_skips'] = self.num_tune_skips
+        for (idx, expert) in enumerate(self.experts):
+            prefix = 'expert_' + str(idx) + '.'
+            for key, val in expert.get_state().iteritems():
+                state[prefix + key] = val
+        return state
+
+    def set_state(self, state):
+        self.stop_workers()  # The workers restart from the restored state on the next simulated day
+        super(ExpertPool, self).set_state(state)
+        self.weights_history[...] = state['weights_history']
+        self.num_held_days[...] = state['num_held_days']
+        self.dormant[...] = state['dormant']
+        self.num_dormant_days[...] = state['num_dormant_days']
+        self.num_wakeups[...] = state['num_wakeups']
+        self.num_catch_ups[...] = state['num_catch_ups']
+        self.num_tune_skips[...] = state['num_tune_skips']
+        self.rolling_sharpe = None  # The running sums are rebuilt from the restored dollar histories
+        for (idx, expert) in enumerate(self.experts):
+            prefix = 'expert_' + str(idx) + '.'
+            expert_state = dict((key[len(prefix):], val) for key, val in state.iteritems() if key.startswith(prefix))
+            expert.set_state(expert_state)
+            if expert.b is not None:
+                self.expert_b[idx] = expert.get_b()  # Dormant experts keep their frozen allocations in expert_b
+
     def get_hyperparams_dict(self):
         hyperparams = {
             'Eta': str(self.ew_eta),
@@ -0,0 +1,160 @@
+import os
+import numpy as np
+
+
+class StreamingHistory(object):
+    """
+    Append-only (num_rows x num_days) history (e.g. a portfolio's b_history) with a bounded memory footprint.
+
+    Only the most recent |tail_len| columns are kept in memory, so lookups such as b_history[:, day_idx] or
+    b_history[:, cur_day - tune_duration] are served from RAM. Older columns are collected into chunks of
+    |chunk_len| columns and appended to |store_dir| as .npy files. Columns are addressed the same way as
+    in a dense array: history[:, day] returns (a view of) column |day| and history[:, day] = x sets it.
+    """
+
+    def __init__(self, store_dir, num_rows, num_days, tail_len=32, chunk_len=256, name='b_history'):
+        """
+        :param store_dir: Directory for the chunk files (must end in '/')
+        :param num_rows: Number of rows (e.g. number of stocks)
+        :param num_days: Total number of columns
+        :param tail_len: Number of recent columns kept in memory
+        :param chunk_len: Number of columns per chunk file
+        :param name: Prefix of the chunk files
+        """
+        if not os.path.exists(store_dir):
+            os.makedirs(store_dir)
+
+        self.store_dir = store_dir
+        self.name = name
+        self.shape = (num_rows, num_days)
+        self.tail_len = tail_len
+        self.chunk_len = chunk_len
+
+        self.tail = np.zeros((num_rows, tail_len))  # ring buffer of the most recent columns
+        self.tail_start = 0  # 1st column that is still held in the tail
+        self.pending = np.zeros((num_rows, chunk_len))  # evicted columns that haven't been written yet
+        self.num_chunks = 0  # Number of chunk files written so far
+
+    def __getitem__(self, key):
+        return self.get_column(self.parse_key(key))
+
+    def __setitem__(self, key, value):
+        self.get_column(self.parse_key(key))[...] = value
+
+    def parse_key(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2 and key[0] == slice(None)):
+            raise Exception('StreamingHistory only supports column access, i.e. history[:, day].')
+        col = int(key[1])
+        if col < 0:
+            col += self.shape[1]
+        if not 0 <= col < self.shape[1]:
+            raise IndexError('Column ' + str(key[1]) + ' is out of range for a history with ' +
+                             str(self.shape[1]) + ' columns.')
+        return col
+
+    def get_column(self, col):
+        """
+        :return: A writable view of column |col| if it's in the tail. Otherwise a read-only copy.
+        """
+        if col >= self.tail_start + self.tail_len:
+            self.advance(col - self.tail_len + 1)
+        return self.read_column(col)
+
+    def read_column(self, col):
+        """
+        Read column |col| without moving the tail. Columns past the tail haven't been written yet (zeros).
+        """
+        if self.tail_start <= col < self.tail_start + self.tail_len:
+            return self.tail[:, col % self.tail_len]
+
+        if col >= self.tail_start:
+            column = np.zeros(self.shape[0])
+        else:
+            # The column has already been evicted from the tail
+            chunk_idx = col // self.chunk_len
+            if chunk_idx == self.num_chunks:
+                column = self.pending[:, col % self.chunk_len].copy()
+            else:
+                column = np.array(np.load(self.chunk_path(chunk_idx), mmap_mode='r')[:, col % self.chunk_len])
+        column.flags.writeable = False
+        return column
+
+    def advance(self, new_tail_start):
+        """
+        Evict every column before |new_tail_start| from the tail.
+        """
+        for col in range(self.tail_start, new_tail_start):
+            slot = col % self.tail_len
+            self.pending[:, col % self.chunk_len] = self.tail[:, slot]
+            self.tail[:, slot] = 0
+            if (col + 1) % self.chunk_len == 0:
+                self.write_chunk()
+        self.tail_start = new_tail_start
+
+    def write_chunk(self):
+        np.save(self.chunk_path(self.num_chunks), self.pending)
+        self.pending[...] = 0
+        self.num_chunks += 1
+
+    def chunk_path(self, chunk_idx):
+        return self.store_dir + self.name + '_chunk_' + str(chunk_idx).zfill(5) + '.npy'
+
+    def flush(self):
+        """
+        Write every remaining column to disk.
+        """
+        if self.tail_start < self.shape[1]:
+            self.advance(self.shape[1])
+        if self.num_chunks * self.chunk_len < self.shape[1]:
+            self.write_chunk()
+
+    def save(self, path, extra_cols=None):
+        """
+        Assemble the full history into a single .npy file at |path| (which can be memory mapped), one
+        chunk at a time so that the full array is never held in memory.
+
+        :param extra_cols: Optional (num_rows x k) array to append after the last column
+        """
+        self.flush()
+        num_extra = 0 if extra_cols is None else extra_cols.shape[1]
+        num_rows, num_cols = self.shape
+        out = np.lib.format.open_memmap(path, mode='w+', shape=(num_rows, num_cols + num_extra))
+        for chunk_idx in range(self.num_chunks):
+            chunk = np.load(self.chunk_path(chunk_idx), mmap_mode='r')
+            col_start = chunk_idx * self.chunk_len
+            col_stop = min(col_start + self.chunk_len, num_cols)
+            out[:, col_start:col_stop] = chunk[:, :col_stop - col_start]
+        if num_extra:
+            out[:, num_cols:] = extra_cols
+        out.flush()
+        del out
+
+    def to_array(self):
+        """
+        :return: The full (num_rows x num_days) history as a dense array.
+        """
+        return np.column_stack([self.read_column(col) for col in range(self.shape[1])])
+
+    def get_state(self):
+        """
+        In-memory part of the history (the chunk files on disk stay where they are).
+        """
+        return {
+            'tail': self.tail,
+            'tail_start': self.tail_start,
+            'pending': self.pending,
+            'num_chunks': self.num_chunks,
+        }
+
+    def set_state(self, state):
+        self.tail[...] = state['tail']
+        self.tail_start = int(state['tail_start'])
+        self.pending[...] = state['pending']
+        self.num_chunks = int(state['num_chunks'])
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held in memory
+        """
+        return self.tail.nbytes + self.pending.nbytes
@@ -1,6 +1,21 @@
+import ctypes
+import hashlib
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
 import util
 
 
+def to_shared_array(arr):
+    """
+    :return: Copy of |arr| backed by shared memory, so that writes are seen by forked processes
+    """
+    raw = RawArray(ctypes.c_byte, max(arr.nbytes, 1))
+    shared = np.frombuffer(raw, dtype=arr.dtype, count=arr.size).reshape(arr.shape)
+    shared[...] = arr
+    return shared
+
+
 class MarketData:
     """
     Class to represent S&P 500 stock market data.
@@ -28,9 +43,90 @@ class MarketData:
         }
         self.stock_names = stocks
 
+        # A stock can only be traded on days where its opening price is available
+        self.active = np.isfinite(op)
+        self.inactive = np.logical_not(self.active)
+        self.fingerprint_digest = None  # Memoized fingerprint (reset whenever the prices change)
+
+    def fingerprint(self):
+        """
+        :return: Hex digest of the raw prices and stock names, e.g. to key cached results (see result_cache).
+        Computed once and reset by reserve_days and set_day (so don't modify the arrays directly).
+        """
+        if self.fingerprint_digest is None:
+            sha = hashlib.sha1()
+            for key in sorted(self.raw.keys()):
+                vals = np.ascontiguousarray(self.raw[key])
+                sha.update(key + str(vals.shape))
+                sha.update(vals.tobytes())
+            sha.update('\n'.join(str(name) for name in np.ravel(self.stock_names)))
+            self.fingerprint_digest = sha.hexdigest()
+        return self.fingerprint_digest
+
     def get_std_cl(self):
         return self.standardized['cl']
 
+    def reserve_days(self, num_days):
+        """
+        Extend every array to |num_days| rows of NaNs, so that future days can be filled in place with
+        set_day. Do this before creating any portfolios on this data (they keep references to the arrays).
+        """
+        num_extra = num_days - self.raw['op'].shape[0]
+        if num_extra <= 0:
+            return
+
+        for prices in (self.raw, self.relative, self.standardized):
+            for key, vals in prices.items():
+                padding = np.NaN * np.ones((num_extra, vals.shape[1]))
+                prices[key] = np.concatenate((vals, padding), axis=0)
+        self.active = np.isfinite(self.raw['op'])
+        self.inactive = np.logical_not(self.active)
+        self.fingerprint_digest = None
+
+    def share_memory(self):
+        """
+        Move every array into shared memory, so that worker processes forked from this one (see
+        ExpertPool.enable_parallel) read the same prices, including days filled in later with set_day.
+        Like reserve_days, do this before creating any portfolios on this data.
+        """
+        for prices in (self.raw, self.relative, self.standardized):
+            for key, vals in prices.items():
+                prices[key] = to_shared_array(vals)
+        self.active = to_shared_array(self.active)
+        self.inactive = to_shared_array(self.inactive)
+
+    def set_day(self, day, op, cl, vol=None, lo=None, hi=None):
+        """
+        Fill in the prices of |day| (e.g. as they arrive during live trading). Updates the raw and relative
+        prices in place. Note that the standardized closing prices are not updated.
+        """
+        new_prices = {'vol': vol, 'op': op, 'lo': lo, 'hi': hi, 'cl': cl}
+        for key, vals in new_prices.iteritems():
+            row = np.NaN * np.ones(len(self.stock_names)) if vals is None else np.asarray(vals, dtype=float)
+            self.raw[key][day, :] = row
+
+            # Same convention as util.get_price_relatives
+            rel_row = self.relative[key][day, :]
+            rel_row[...] = 0
+            if day > 0:
+                prev_row = self.raw[key][day-1, :]
+                both_nonzero = np.logical_and(row != 0, prev_row != 0)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    rel_row[both_nonzero] = 1.0 * row[both_nonzero] / prev_row[both_nonzero]
+
+        self.active[day, :] = np.isfinite(self.raw['op'][day, :])
+        self.inactive[day, :] = np.logical_not(self.active[day, :])
+        self.fingerprint_digest = None
+
+    def get_active(self):
+        """
+        :return: (NUM_DAYS x NUM_STOCKS) boolean array. True where the stock can be traded.
+        """
+        return self.active
+
+    def get_inactive(self):
+        return self.inactive
+
     def get_vol(self, relative=True):
         """
         :param relative: If True, get the relative values. Otherwise
@@ -1,7 +1,10 @@
 import numpy as np
 from constants import init_dollars
+import tracing
 import util
 from portfolio import Portfolio
+from profiling import array_nbytes
+from result_cache import hash_array
 
 #import matplotlib.pyplot as plt
 from cvxpy import *
@@ -41,7 +44,7 @@ class NonParametricMarkowitz(Portfolio):
         if(day <= window-1):
             available = util.get_avail_stocks(self.data_train.get_op()[-1, :])
 
-        available_inds = np.asarray([i for i in range(497) if available[i] > 0])
+        available_inds = np.asarray([i for i in range(self.num_stocks) if available[i] > 0])
 
         if(day >= window-1):
             op = self.data.get_op()[day-window+1:day+1,available_inds]
@@ -121,7 +124,8 @@ class NonParametricMarkowitz(Portfolio):
             constraints = [c>= b, c >= -b, sum_entries(c)==1]	#, b <= self.cap, b>= - self.cap] #[b >= 0, np.ones(num_available).T*b == 1]
             objective = Minimize(d)
             prob = Problem(objective, constraints)
-            prob.solve()
+            with tracing.span('npm_solve', day=cur_day, num_stocks=num_available):
+                prob.solve()
 
             new_allocation = np.zeros(len(available))
             new_allocation[available_inds] = b.value
@@ -144,11 +148,11 @@ class NonParametricMarkowitz(Portfolio):
         num_examples = cur_day-1
 
         if(self.data_train is not None):
-            num_examples += 1247
+            num_examples += self.data_train.get_cl().shape[0]
 
         # If the parameters are uninitialized, initialize them
-        if(self.mu == None):
-            assert(self.sigma == None)
+        if(self.mu is None):
+            assert(self.sigma is None)
             self.mu = np.zeros(num_total_stocks).astype(float)
             self.sigma = np.zeros((num_total_stocks,num_total_stocks)).astype(float)
          
@@ -162,6 +166,16 @@ class NonParametricMarkowitz(Portfolio):
             else:
                 self.sigma = N/(N+1.0) * (self.sigma + np.diag(mu_N**2)) - np.diag(self.mu**2) + 1/(N+1.0)*np.diag(last_close**2)
     
+    def get_cache_params(self):
+        params = super(NonParametricMarkowitz, self).get_cache_params()
+        params['window_len'] = self.window_len
+        params['k'] = self.k
+        params['risk_aversion'] = float(self.risk_aversion)
+        params['start_date'] = self.start_date
+        params['mu'] = hash_array(self.mu)  # Loaded from past results (if any)
+        params['sigma'] = hash_array(self.sigma)
+        return params
+
     def get_hyperparams_dict(self):
         hyperparams = {
             'Window': str(self.window_len),
@@ -175,18 +189,30 @@ class NonParametricMarkowitz(Portfolio):
         if self.new_results_dir is None:
             return
 
-        print 'Saving ', self.portfolio_type
-        save_dir = self.new_results_dir
-
-        # Add final portfolio
-        self.b_history = np.concatenate((self.b_history, np.reshape(self.b, (-1,1))), axis=1)
-
-        util.save_dollars_history(save_dir=save_dir, dollars=self.dollars_op_history, portfolio_type=self.portfolio_type)
-        util.save_b_history(save_dir=save_dir, b_history=self.b_history, portfolio_type=self.portfolio_type)
-        util.save_hyperparams(save_dir=save_dir, hyperparams_dict=self.get_hyperparams_dict(), portfolio_type=self.portfolio_type)
-        self.save_state(save_dir=save_dir)
+        super(NonParametricMarkowitz, self).save_results()
+        self.save_state(save_dir=self.new_results_dir)
         return
 
+    def get_state(self):
+        state = super(NonParametricMarkowitz, self).get_state()
+        if self.mu is not None:
+            state['mu'] = self.mu
+            state['sigma'] = self.sigma
+        return state
+
+    def set_state(self, state):
+        super(NonParametricMarkowitz, self).set_state(state)
+        if 'mu' in state:
+            self.mu = np.array(state['mu'])
+            self.sigma = np.array(state['sigma'])
+
+    def memory_usage(self):
+        usage = super(NonParametricMarkowitz, self).memory_usage()
+        stats_bytes = array_nbytes(self.mu, self.sigma)  # sigma is a dense (num_stocks x num_stocks) matrix
+        usage['stats'] += stats_bytes
+        usage['total'] += stats_bytes
+        return usage
+
     def save_state(self, save_dir):
         np.save(save_dir + 'mu.npy', self.mu)
         np.save(save_dir + 'sigma.npy', self.sigma)
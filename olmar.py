@@ -1,6 +1,7 @@
 import itertools
 from math import pow
 import numpy as np
+import tracing
 import util
 from portfolio import Portfolio
 
@@ -48,6 +49,8 @@ class OLMAR(Portfolio):
         self.eps_hist = [eps]
         self.window_range = window_range
         self.eps_range = eps_range
+        self.tune_children = None  # Backtest of each candidate (window, eps), kept in incremental tuning mode
+        self.max_tune_age = None
         self.new_results_dir = new_results_dir
 
         super(OLMAR, self).__init__(market_data=market_data, market_data_train=market_data_train, start=start, stop=stop, rebal_interval=rebal_interval,
@@ -126,7 +129,8 @@ class OLMAR(Portfolio):
             cur_day_op = self.data.get_op(relative=False)[day, :]  # opening prices on |cur_day|
             return util.get_uniform_allocation(self.num_stocks, cur_day_op)
 
-        predicted_price_rel = self.predict_price_relatives(day)
+        with tracing.span('predict_price_relatives', day=day):
+            predicted_price_rel = self.predict_price_relatives(day)
 
         # Compute mean price relative of available stocks (x bar at t+1)
         today_op = self.data.get_op(relative=False)[day, :]
@@ -171,10 +175,7 @@ class OLMAR(Portfolio):
         # Compute sharpe ratios for each setting of hyperparams
         sharpe_ratios = []
         for (win, eps) in hyp_combos:
-            cur_portfolio = OLMAR(market_data=self.data, start=start_day, stop=cur_day,
-                                init_b=init_b, window=win, eps=eps, tune_interval=None, verbose=False, silent=True)
-            cur_portfolio.run(start_day, cur_day)
-            cur_dollars_history = cur_portfolio.get_dollars_history()
+            cur_dollars_history = self.backtest_candidate(win, eps, start_day, cur_day, init_b)
             sharpe_ratios.append(util.empirical_sharpe_ratio(cur_dollars_history))
 
         best_window, best_eps = hyp_combos[sharpe_ratios.index(max(sharpe_ratios))]
@@ -184,6 +185,62 @@ class OLMAR(Portfolio):
         self.window_hist.append(best_window)
         return
 
+    def backtest_candidate(self, win, eps, start_day, cur_day, init_b):
+        """
+        Run a portfolio of this class with the candidate hyperparameters (|win|, |eps|) over the tuning period
+        from |start_day| to |cur_day|, starting from the allocation |init_b|.
+
+        :return: Dollar history over the tuning period
+        """
+        if self.tune_children is not None:
+            return self.extend_candidate(win, eps, start_day, cur_day, init_b)
+
+        with tracing.span('child_backtest', window=win, eps=eps, start=start_day, stop=cur_day):
+            cur_portfolio = self.make_candidate(win, eps, start_day, cur_day, init_b)
+            cur_portfolio.enable_result_cache(self.result_cache, dollars_only=True)
+            cur_portfolio.run(start_day, cur_day)
+        return cur_portfolio.get_dollars_history()
+
+    def enable_incremental_tuning(self, max_age=50):
+        """
+        Reuse the candidates' backtests across tuning days. When tune_interval is shorter than the tuning
+        period, consecutive tuning periods overlap, so instead of backtesting each candidate from scratch,
+        its backtest from the previous tuning is extended by the days added since then and the Sharpe
+        ratio is computed on the days of the current tuning period. Only the new days are simulated.
+
+        A reused backtest started from the allocation at the start of an earlier tuning period (rather
+        than the current one), so the Sharpe ratios, and therefore the chosen hyperparameters, can differ
+        slightly from regular tuning. A candidate's backtest restarts from the current allocation when it
+        doesn't overlap the tuning period or it would run for more than |max_age| days. The backtests are
+        part of the state (see get_state), so a run restored from a checkpoint tunes the same way.
+
+        :param max_age: Max number of days of a candidate's backtest (at least the tuning period)
+        """
+        self.tune_children = {}
+        self.max_tune_age = max_age
+
+    def extend_candidate(self, win, eps, start_day, cur_day, init_b):
+        """
+        Incremental version of backtest_candidate (see enable_incremental_tuning).
+        """
+        child = self.tune_children.get((win, eps))
+        if child is None or child.last_day is None or start_day > child.last_day or cur_day > child.stop:
+            with tracing.span('child_backtest', window=win, eps=eps, start=start_day, stop=cur_day):
+                stop = min(start_day + self.max_tune_age, self.data.get_vol().shape[0])
+                child = self.make_candidate(win, eps, start_day, max(stop, cur_day), init_b)
+                for day in range(start_day, cur_day):
+                    child.update(day, day == start_day)
+            self.tune_children[(win, eps)] = child
+        else:
+            with tracing.span('child_extend', window=win, eps=eps, start=child.last_day + 1, stop=cur_day):
+                for day in range(child.last_day + 1, cur_day):
+                    child.update(day)
+        return child.dollars_op_history[start_day - child.start:cur_day - child.start]
+
+    def make_candidate(self, win, eps, start, stop, init_b):
+        return self.__class__(market_data=self.data, start=start, stop=stop, init_b=init_b, window=win, eps=eps,
+                              tune_interval=None, verbose=False, silent=True)
+
     def print_results(self):
         if self.verbose:
             print 30 * '-'
@@ -191,6 +248,53 @@ class OLMAR(Portfolio):
             print 30 * '-'
         Portfolio.print_results(self)
 
+    def get_state(self):
+        """
+        In incremental tuning mode, the state includes the candidates' backtests: 'tune_children' has the
+        (window, eps, start, stop) of each, and the entries of backtest i are prefixed with 'tune_child_i.'
+        """
+        state = super(OLMAR, self).get_state()
+        state['window'] = self.window
+        state['eps'] = self.eps
+        state['window_hist'] = np.array(self.window_hist)
+        state['eps_hist'] = np.array(self.eps_hist)
+        if self.tune_children is not None:
+            candidates = sorted(self.tune_children)
+            state['tune_children'] = np.array([(win, eps, self.tune_children[(win, eps)].start,
+                                                self.tune_children[(win, eps)].stop) for (win, eps) in candidates],
+                                              dtype=float).reshape(-1, 4)
+            for (idx, candidate) in enumerate(candidates):
+                prefix = 'tune_child_' + str(idx) + '.'
+                for key, val in self.tune_children[candidate].get_state().iteritems():
+                    state[prefix + key] = val
+        return state
+
+    def set_state(self, state):
+        super(OLMAR, self).set_state(state)
+        self.window = int(state['window'])
+        self.eps = float(state['eps'])
+        self.window_hist = [int(win) for win in state['window_hist']]
+        self.eps_hist = [float(eps) for eps in state['eps_hist']]
+        if self.tune_children is not None:
+            self.tune_children = {}
+            for (idx, (win, eps, start, stop)) in enumerate(state.get('tune_children', [])):
+                prefix = 'tune_child_' + str(idx) + '.'
+                child = self.make_candidate(int(win), float(eps), int(start), int(stop), None)
+                child.set_state(dict((key[len(prefix):], val) for key, val in state.iteritems()
+                                     if key.startswith(prefix)))
+                self.tune_children[(child.window, child.eps)] = child
+
+    def get_cache_params(self):
+        params = super(OLMAR, self).get_cache_params()
+        # Exact values (the hyperparams dictionary rounds them)
+        params['window'] = int(self.window)
+        params['eps'] = float(self.eps)
+        params['window_range'] = [int(win) for win in self.window_range]
+        params['eps_range'] = [float(eps) for eps in self.eps_range]
+        params['incremental_tuning'] = self.tune_children is not None
+        params['max_tune_age'] = self.max_tune_age
+        return params
+
     def get_hyperparams_dict(self):
         hyperparams = {
             'Window': str(self.window),
@@ -0,0 +1,119 @@
+"""
+    Worker processes that step the experts of an ExpertPool concurrently (see ExpertPool.enable_parallel).
+
+    Each expert is forked into its own process, which keeps simulating it. Every day the pool sends
+    the day to all workers and then waits for all of them (a per-day barrier), so the day takes as long
+    as the slowest expert instead of the sum of all experts. Each worker replies with the expert's new
+    allocation and dollar values, which are copied into the pool's copy of the expert (its mirror).
+    The rest of the expert's state is only copied back on request (sync_state).
+
+    The workers read the market data they inherited at fork. For live trading, where days are filled
+    in with MarketData.set_day after the workers start, call MarketData.share_memory first.
+
+"""
+
+import multiprocessing
+import traceback
+
+
+def worker_loop(expert, conn):
+    """
+    Serve commands from the pool until told to stop:
+        ('update', cur_day, init, tune) -> ('ok', (b, dollars at the next open, dollars at today's close,
+                                                   time of the last tuning))
+        ('hold', cur_day)               -> Same as 'update', but only does the accounting (Portfolio.hold)
+        ('get_state',)                  -> ('ok', (state, timer, memory_tracker))
+        ('stop',)
+    Errors are sent back as ('error', traceback) instead of killing the worker silently.
+    """
+    while True:
+        command = conn.recv()
+        if command[0] == 'stop':
+            break
+        try:
+            if command[0] in ('update', 'hold'):
+                if command[0] == 'update':
+                    _, cur_day, init, tune = command
+                    expert.update(cur_day, init, tune)
+                else:
+                    _, cur_day = command
+                    expert.hold(cur_day)
+                day_idx = cur_day - expert.start
+                next_dollars = None
+                if day_idx + 1 < expert.num_days:
+                    next_dollars = expert.dollars_op_history[day_idx+1]
+                reply = (expert.get_b(), next_dollars, expert.dollars_cl_history[day_idx],
+                         expert.last_tune_seconds)
+            elif command[0] == 'get_state':
+                reply = (expert.get_state(), expert.timer, expert.memory_tracker)
+            else:
+                raise Exception('Unknown command sent to expert worker: ' + str(command[0]))
+            conn.send(('ok', reply))
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+    conn.close()
+
+
+class ExpertWorker(object):
+    """
+    Parent side of a worker process running |expert|. |expert| stays in the parent as the mirror.
+    """
+
+    def __init__(self, expert):
+        self.expert = expert
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=worker_loop, args=(expert, child_conn))
+        self.process.daemon = True  # Don't outlive the parent if a run is interrupted
+        self.process.start()
+        child_conn.close()
+
+    def receive(self):
+        status, reply = self.conn.recv()
+        if status == 'error':
+            raise Exception('Expert worker failed:\n' + reply)
+        return reply
+
+    def send_update(self, cur_day, init=False, tune=True):
+        self.conn.send(('update', cur_day, init, tune))
+
+    def send_hold(self, cur_day):
+        self.conn.send(('hold', cur_day))
+
+    def poll(self, timeout):
+        """
+        :return: True if the worker's reply arrives within |timeout| seconds
+        """
+        return self.conn.poll(timeout)
+
+    def receive_update(self, cur_day):
+        """
+        Wait for the worker to finish |cur_day| and copy its results into the mirror.
+
+        :return: The expert's new allocation
+        """
+        b, next_dollars, cl_dollars, last_tune_seconds = self.receive()
+        expert = self.expert
+        day_idx = cur_day - expert.start
+        expert.b = b
+        if next_dollars is not None:
+            expert.dollars_op_history[day_idx+1] = next_dollars
+        expert.dollars_cl_history[day_idx] = cl_dollars
+        expert.last_day = cur_day
+        expert.last_tune_seconds = last_tune_seconds
+        return b
+
+    def sync_state(self):
+        """
+        Copy the worker's complete expert state (including its histories, timings and memory events) into
+        the mirror.
+        """
+        self.conn.send(('get_state',))
+        state, timer, memory_tracker = self.receive()
+        self.expert.set_state(state)
+        self.expert.timer = timer
+        self.expert.memory_tracker = memory_tracker
+
+    def stop(self):
+        self.conn.send(('stop',))
+        self.process.join()
+        self.conn.close()
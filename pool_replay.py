@@ -0,0 +1,308 @@
+"""
+    Replay of ExpertPool configurations over precomputed expert histories.
+
+    The experts of a pool don't depend on the pool's weighting, so they only need to be run once
+    (record_expert_histories). PoolReplay then evaluates any number of pool configurations
+    (weighting_strategy, windows, ew_alpha, ew_eta) without re-running the experts:
+        - The expert weights of every day are computed at once from prefix sums over the stored
+          dollar histories (the same formulas as ExpertPool, vectorized over days).
+        - The pools' accounting advances every configuration together in a BatchAccounting.
+
+    Usage:
+        record_expert_histories(experts, 'replay/')
+        replay = PoolReplay.load(market_data, 'replay/')
+        accounting = replay.run([{'ew_eta': 0.8}, {'ew_eta': 2.0, 'windows': [5, 20]}])
+        print accounting.get_sharpe_ratios()
+
+    To sweep a grid of configurations (the experts run once, the first time):
+        configs = make_pool_configs(windows_list=[[5], [10, 20]], ew_alphas=[0.3, 0.5], ew_etas=[0.5, 1, 2])
+        print_sweep_results(sweep_pool_hyperparams(market_data, 'replay/', configs, experts=experts))
+
+"""
+
+import itertools
+import json
+import os
+import numpy as np
+from batch_accounting import BatchAccounting
+from constants import init_dollars
+from rolling_sharpe import RollingSharpe
+from util import format_value
+
+# Default pool configuration (same defaults as ExpertPool)
+default_pool_config = {
+    'weighting_strategy': 'exp_window',
+    'windows': [10],
+    'ew_alpha': 0.5,
+    'ew_eta': 0.8,
+}
+
+
+def record_expert_histories(experts, save_dir, start=0, stop=None):
+    """
+    Run each expert once, day by day as an ExpertPool would, and store what's needed to replay pools of them
+    in |save_dir| (must end in '/'):
+        expert_allocations.npy: (num_days x num_experts x num_stocks) allocation of each expert at the end
+        of each day (day-major, so a day's allocations are contiguous)
+        expert_dollars.npy: (num_experts x num_days) dollars of each expert at the open of each day
+        expert_past_dollars.npy: Past dollar histories (only if the experts were loaded with previous results)
+        replay_meta.json: Type and hyperparameters of each expert
+
+    :param experts: List of Portfolio objects that haven't been run yet
+    :return: None
+    """
+    if stop is None:
+        stop = experts[0].stop
+    num_days = stop - start
+    num_experts = len(experts)
+    num_stocks = experts[0].num_stocks
+
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    allocations = np.lib.format.open_memmap(save_dir + 'expert_allocations.npy', mode='w+', dtype=float,
+                                            shape=(num_days, num_experts, num_stocks))
+    for day in range(start, stop):
+        for (idx, expert) in enumerate(experts):
+            expert.update(day, day == start)
+            allocations[day - start, idx] = expert.get_b()
+    allocations.flush()
+    del allocations
+
+    np.save(save_dir + 'expert_dollars.npy', np.array([expert.get_dollars_history()[:num_days] for expert in experts]))
+    if experts[0].past_dollars_history is not None:
+        np.save(save_dir + 'expert_past_dollars.npy',
+                np.array([expert.past_dollars_history for expert in experts], dtype=float))
+
+    meta = {
+        'start': start,
+        'stop': stop,
+        'experts': [{'portfolio_type': getattr(expert, 'portfolio_type', expert.__class__.__name__),
+                     'hyperparams': expert.get_hyperparams_dict()} for expert in experts],
+    }
+    meta_file = open(save_dir + 'replay_meta.json', 'w')
+    json.dump(meta, meta_file, indent=2, sort_keys=True)
+    meta_file.close()
+
+
+class PoolReplay(object):
+    """
+    Evaluates ExpertPool configurations on stored expert histories.
+    """
+
+    def __init__(self, market_data, expert_allocations, expert_dollars, past_dollars=None, start=0):
+        """
+        :param market_data: Stock market data (MarketData object) the experts ran on
+        :param expert_allocations: (num_days x num_experts x num_stocks) allocation of each expert at the end
+        of each day (may be a memory map)
+        :param expert_dollars: (num_experts x num_days) dollars of each expert at the open of each day
+        :param past_dollars: (num_experts x num_past_days) past dollar histories of the experts, or None
+        :param start: First day of the histories
+        """
+        self.data = market_data
+        self.expert_allocations = expert_allocations
+        self.expert_dollars = np.asarray(expert_dollars)
+        self.past_dollars = past_dollars
+        self.num_days, self.num_experts, self.num_stocks = expert_allocations.shape
+        self.start = start
+        self.stop = start + self.num_days
+        self.rolling_sharpe = RollingSharpe(self.expert_dollars, past_dollars)
+        self.sharpe_cache = {}  # Sharpe ratios of the windows used so far (see get_window_sharpes)
+
+    @classmethod
+    def load(cls, market_data, replay_dir, mmap_mode='r'):
+        """
+        Load the histories written by record_expert_histories. The allocations are memory mapped.
+        """
+        meta_file = open(replay_dir + 'replay_meta.json')
+        meta = json.load(meta_file)
+        meta_file.close()
+
+        expert_allocations = np.load(replay_dir + 'expert_allocations.npy', mmap_mode=mmap_mode)
+        expert_dollars = np.load(replay_dir + 'expert_dollars.npy')
+        past_dollars = None
+        if os.path.exists(replay_dir + 'expert_past_dollars.npy'):
+            past_dollars = np.load(replay_dir + 'expert_past_dollars.npy')
+        return cls(market_data, expert_allocations, expert_dollars, past_dollars, start=meta['start'])
+
+    def get_weights(self, weighting_strategy='exp_window', windows=[10], ew_alpha=0.5, ew_eta=0.8):
+        """
+        Weights an ExpertPool with this configuration gives its experts on every day.
+
+        :return: (num_days x num_experts) array of weights
+        """
+        weights = np.zeros((self.num_days, self.num_experts))
+
+        # Use uniform weights for all experts, since we have limited info (see ExpertPool.get_new_allocation)
+        num_uniform = min(3, self.num_days)
+        weights[:num_uniform] = 1.0 / self.num_experts
+        days = np.arange(num_uniform, self.num_days)
+        if len(days) == 0:
+            return weights
+
+        if weighting_strategy == 'exp_window':
+            scores = self.recent_sharpe_scores(days, windows, ew_alpha, ew_eta)
+        elif weighting_strategy == 'ma_perf':
+            scores = self.ma_performance_scores(days, windows)
+        elif weighting_strategy == 'open_price':
+            scores = self.open_price_scores(days)
+        else:
+            raise Exception('PoolReplay does not support the ' + weighting_strategy + ' weighting strategy.')
+
+        # Normalize to obtain weights that sum to 1
+        weights[num_uniform:] = (scores / np.sum(scores, axis=0)).T
+        bad_days = np.nonzero(~np.all(np.isfinite(weights), axis=1))[0]
+        if len(bad_days) > 0:
+            raise Exception('The ' + weighting_strategy + ' weights of the experts on day ' +
+                            str(bad_days[0] + self.start) + ' are not finite: ' + str(weights[bad_days[0]]))
+        return weights
+
+    def recent_sharpe_scores(self, days, windows, ew_alpha, ew_eta):
+        """
+        Vectorized ExpertPool.recent_sharpe_weighting (before normalization). Like there, the exponents of each
+        day are shifted by the largest one.
+
+        :return: (num_experts x len(days)) array
+        """
+        scores = np.zeros((self.num_experts, len(days)))
+        if self.past_dollars is None:
+            # Not enough data to use all of the windows: use a single window since the 1st day
+            short = days < sum(windows)
+            if np.any(short):
+                exponent = ew_eta * self.get_window_sharpes(days[short], 0, None)
+                scores[:, short] = np.exp(exponent - np.max(exponent, axis=0))
+        else:
+            short = np.zeros(len(days), dtype=bool)
+
+        full_days = days[~short]
+        if len(full_days) == 0:
+            return scores
+        exponents = []
+        offset = 0
+        for window in windows:
+            exponents.append(ew_eta * self.get_window_sharpes(full_days, offset, window))
+            offset += window
+        shift = np.max(exponents, axis=(0, 1))
+        for (w, exponent) in enumerate(exponents):
+            # Perform Exponential Weighting and Scale Down Older Windows
+            scores[:, ~short] += (1.0 * ew_alpha)**w * np.exp(exponent - shift)
+        return scores
+
+    def get_window_sharpes(self, days, offset, window):
+        """
+        Sharpe ratios of the window of |window| days ending |offset| days before each of |days| (a range of
+        consecutive days). If |window| is None, the windows start at day 0. The results are memoized, since a
+        sweep evaluates the same windows for many configurations.
+
+        :return: (num_experts x len(days)) array
+        """
+        key = (days[0], len(days), offset, window)
+        if key not in self.sharpe_cache:
+            stops = days - offset
+            starts = np.zeros_like(stops) if window is None else stops - window
+            self.sharpe_cache[key] = self.rolling_sharpe.get_sharpe_ratios(starts, stops)
+        return self.sharpe_cache[key]
+
+    def ma_performance_scores(self, days, windows):
+        """
+        Vectorized ExpertPool.ma_performance_weighting (before normalization).
+
+        :return: (num_experts x len(days)) array
+        """
+        window = np.minimum(windows[0], days)
+        cur_dollars = self.expert_dollars[:, days]
+        window_start_dollars = self.expert_dollars[:, days - window]
+        return (cur_dollars - window_start_dollars) * (1.0 / window)
+
+    def open_price_scores(self, days):
+        """
+        Vectorized ExpertPool.open_price_weighting (before normalization): Portfolio.predict_performance of
+        each expert's allocation on each day, with the closing prices predicted by util.predict_prices.
+
+        :return: (num_experts x len(days)) array
+        """
+        est_cl_rel = np.nan_to_num(self.data.get_op(relative=True)[days + self.start])
+        return np.einsum('des,ds->ed', self.expert_allocations[days[0]:days[-1]+1], est_cl_rel)
+
+    def get_target_b(self, weights, day):
+        """
+        :param weights: (num_configs x num_days x num_experts) weights of each pool configuration
+        :return: (num_configs x num_stocks) allocations of the pools at the end of |day| (like
+        ExpertPool.aggregate_experts)
+        """
+        net_b = np.dot(weights[:, day - self.start], self.expert_allocations[day - self.start])
+        return net_b / np.sum(np.abs(net_b), axis=1)[:, np.newaxis]
+
+    def run(self, configs, init_dollars=init_dollars, save_b_history=False):
+        """
+        Simulate an ExpertPool for each configuration.
+
+        :param configs: List of dictionaries with ExpertPool arguments (weighting_strategy, windows, ew_alpha,
+        ew_eta). Missing arguments get the ExpertPool defaults.
+        :return: BatchAccounting with one portfolio per configuration (e.g. use get_sharpe_ratios)
+        """
+        weights = np.zeros((len(configs), self.num_days, self.num_experts))
+        for (idx, config) in enumerate(configs):
+            pool_config = dict(default_pool_config)
+            pool_config.update(config)
+            weights[idx] = self.get_weights(**pool_config)
+
+        accounting = BatchAccounting(self.data, len(configs), start=self.start, stop=self.stop,
+                                     init_dollars=init_dollars, save_b_history=save_b_history)
+        accounting.run(lambda day: self.get_target_b(weights, day))
+        return accounting
+
+
+def make_pool_configs(weighting_strategies=('exp_window',), windows_list=([10],), ew_alphas=(0.5,),
+                      ew_etas=(0.8,)):
+    """
+    :return: List of every distinct combination of the given ExpertPool arguments. ew_alpha and ew_eta are
+    only varied for exp_window (and ew_alpha only with more than 1 window), ma_perf only uses the 1st
+    window of each windows list and open_price has no parameters.
+    """
+    configs = []
+    for weighting_strategy in weighting_strategies:
+        if weighting_strategy == 'exp_window':
+            for windows in windows_list:
+                # ew_alpha only scales the windows after the 1st one
+                cur_ew_alphas = ew_alphas if len(windows) > 1 else ew_alphas[:1]
+                for (ew_alpha, ew_eta) in itertools.product(cur_ew_alphas, ew_etas):
+                    configs.append({'weighting_strategy': weighting_strategy, 'windows': list(windows),
+                                    'ew_alpha': float(ew_alpha), 'ew_eta': float(ew_eta)})
+        elif weighting_strategy == 'open_price':
+            configs.append({'weighting_strategy': weighting_strategy})
+        else:
+            for window in sorted(set(windows[0] for windows in windows_list)):
+                configs.append({'weighting_strategy': weighting_strategy, 'windows': [window]})
+    return configs
+
+
+def sweep_pool_hyperparams(market_data, replay_dir, configs, experts=None, batch_size=256):
+    """
+    Evaluate ExpertPool configurations on the same experts, running the experts only once.
+
+    :param replay_dir: Directory with the experts' recorded histories (see record_expert_histories)
+    :param configs: List of ExpertPool arguments to evaluate (e.g. from make_pool_configs)
+    :param experts: If given, run these experts and record their histories in |replay_dir| first.
+    Otherwise, the histories already recorded in |replay_dir| are used.
+    :param batch_size: Number of configurations simulated together (bounds the memory of the accounting)
+    :return: List of (Sharpe ratio, config) tuples, best first
+    """
+    if experts is not None:
+        record_expert_histories(experts, replay_dir)
+    replay = PoolReplay.load(market_data, replay_dir)
+
+    results = []
+    for first in range(0, len(configs), batch_size):
+        batch = configs[first:first+batch_size]
+        sharpes = replay.run(batch).get_sharpe_ratios()
+        results.extend(zip(sharpes.tolist(), batch))
+
+    # Sort by Sharpe ratio (NaN last)
+    results.sort(key=lambda result: -np.inf if np.isnan(result[0]) else result[0], reverse=True)
+    return results
+
+
+def print_sweep_results(results, num_results=10):
+    print 'Sharpe  Configuration'
+    for (sharpe, config) in results[:num_results]:
+        print '%6.3f  %s' % (sharpe, ', '.join(key + '=' + format_value(config[key]) for key in sorted(config.keys())))
@@ -1,8 +1,15 @@
+from timeit import default_timer
 import numpy as np
 
+import tracing
 import util
+from allocation_file import save_allocations
+from batch_accounting import AccountingStep
 from constants import init_dollars
+from history_store import StreamingHistory
 from market_data import MarketData
+from profiling import MemoryTracker, PhaseTimer, array_nbytes, save_summary
+from result_cache import hash_array
 from util import empirical_sharpe_ratio
 #import matplotlib.pyplot as plt
 
@@ -53,6 +60,15 @@ class Portfolio(object):
         self.dollars_cl_history = np.zeros(self.num_days)  # Dollars before close each day
         self.last_close_price = np.NaN * np.ones(self.num_stocks)
         self.sharpe = None  # Sharpe ratio. Calculate after finished running
+        self.last_day = None  # Last day that has been simulated (used for checkpointing)
+        self.timer = None  # PhaseTimer (only set if timing is enabled)
+        self.timing_summary = None
+        self.memory_tracker = None  # MemoryTracker (only set if memory tracking is enabled)
+        self.memory_summary = None
+        self.last_tune_seconds = None  # Wall time of the most recent tune_hyperparams call
+        self.result_cache = None  # ResultCache that run consults first (only set if caching is enabled)
+        self.cache_dollars_only = False  # Whether the cached results only keep the dollar histories
+        self.save_allocation_file = False  # Whether save_results also writes allocations.npy
         self.verbose = verbose
         self.silent = silent
 
@@ -63,36 +79,208 @@ class Portfolio(object):
             self.past_b_history = past_b_history
             self.past_dollars_history = past_dollars_history
             self.len_past = past_b_history.shape[1] - 1
-            self.b = past_b_history[:, -1]  # Use previous b as initialization (overrides |init_b| argument)
+            self.b = np.array(past_b_history[:, -1])  # Use previous b as initialization (overrides |init_b| argument)
         else:
             self.past_b_history = None
             self.past_dollars_history = None
 
         self.repeat_past = repeat_past
+        self.init_work_buffers()
+
+    def init_work_buffers(self):
+        """
+        Preallocate the arrays used by update_dollars and cache the market data it reads every day,
+        so that the daily accounting step does not need to create any new arrays.
+        """
+        self._cl = self.data.get_cl(relative=False)
+        self._active = self.data.get_active()
+        self._inactive = self.data.get_inactive()
+
+        self._value_vec = np.zeros(self.num_stocks)
+        self._accounting = AccountingStep(self.num_stocks)
+
+    def enable_streaming(self, store_dir, tail_len=32, chunk_len=256):
+        """
+        Stream the allocation history to disk instead of keeping the dense (num_stocks x num_days)
+        b_history in memory. Only the last |tail_len| days stay in memory, so the tail must be longer
+        than any look-back into b_history (e.g. the tuning duration). Call this before running.
+
+        :param store_dir: Directory for the history chunks (must end in '/')
+        :param tail_len: Number of recent days of allocations kept in memory
+        :param chunk_len: Number of days per chunk file
+        :return: None
+        """
+        if self.last_day is not None:
+            raise Exception('Streaming must be enabled before the portfolio starts running.')
+        self.b_history = StreamingHistory(store_dir, self.num_stocks, self.num_days,
+                                          tail_len=tail_len, chunk_len=chunk_len)
+
+    def enable_allocation_file(self):
+        """
+        Also write allocations.npy in save_results: a day-major copy of b_history.npy for constant time lookup
+        of any day (see allocation_file.py). It's as large as b_history.npy, so only enable it for the
+        portfolios whose allocations are replayed (e.g. by run_portfolio), not for every expert of a pool.
+        """
+        self.save_allocation_file = True
+
+    def enable_timing(self, timer=None):
+        """
+        Record the wall time of each phase of update (tune_hyperparams, get_new_allocation, update_dollars)
+        on every day. The summary is stored in self.timing_summary at the end of run (and saved to
+        timing.json in the results directory). When timing isn't enabled, nothing is recorded.
+
+        :param timer: PhaseTimer to record into (a new one is created by default)
+        """
+        if timer is None:
+            timer = PhaseTimer()
+        self.timer = timer
+
+    def get_timing_summary(self):
+        return self.timer.summary()
+
+    def enable_memory_tracking(self, tracker=None):
+        """
+        Record the peak memory deltas of tune_hyperparams and get_new_allocation on every day. At the end of
+        run, self.memory_summary holds these together with memory_usage() (and is saved to memory.json in the
+        results directory).
+
+        :param tracker: MemoryTracker to record into (a new one is created by default)
+        """
+        if tracker is None:
+            tracker = MemoryTracker()
+        self.memory_tracker = tracker
+
+    def memory_usage(self):
+        """
+        Bytes held in memory by this portfolio, split into:
+            - history: Allocation and dollar histories (including previous results that aren't memory mapped)
+            - work: Preallocated buffers of update_dollars
+            - stats: Statistics kept by the strategy (e.g. NPM's mu and sigma)
+            - children: Portfolios owned by this one (e.g. the experts of an ExpertPool)
+        Child classes with extra arrays should add them to the matching category.
+
+        :return: Dictionary mapping each category (and 'total') to bytes
+        """
+        usage = {
+            'history': array_nbytes(self.b_history, self.dollars_op_history, self.dollars_cl_history,
+                                    self.past_b_history, self.past_dollars_history),
+            'work': array_nbytes(self.last_close_price, self._value_vec, self._accounting),
+            'stats': 0,
+            'children': 0,
+        }
+        usage['total'] = sum(usage.values())
+        return usage
+
+    def enable_result_cache(self, cache, dollars_only=False):
+        """
+        Look up runs in |cache| (a ResultCache) before simulating them, and store the results of the runs
+        that miss. Portfolios that tune also pass the cache on to the portfolios they backtest while tuning.
+
+        :param cache: ResultCache, or None to stop caching
+        :param dollars_only: If True, the cached results only keep the dollar histories, which makes them
+        much smaller and faster to store (e.g. for the short backtests of tuning, which only need the dollars).
+        A run restored from such a result can't be continued.
+        """
+        self.result_cache = cache
+        self.cache_dollars_only = dollars_only
+
+    def get_cache_params(self):
+        """
+        Everything besides the strategy class, days, initial allocation, market data and code that
+        determines the result of a run (see ResultCache.make_key). Child classes with more settings should
+        add them to this dictionary.
+
+        :return: JSON serializable dictionary, or None if the results can't be cached
+        """
+        return {
+            'hyperparams': self.get_hyperparams_dict(),
+            'rebal_interval': self.rebal_interval,
+            'tune_interval': self.tune_interval,
+            'init_dollars': self.dollars_op_history[0],
+            'repeat_past': self.repeat_past,
+            'past_b_history': hash_array(self.past_b_history),
+            'past_dollars_history': hash_array(self.past_dollars_history),
+            'market_data_train': None if self.data_train is None else self.data_train.fingerprint(),
+        }
+
+    def get_memory_summary(self):
+        summary = {'usage': self.memory_usage()}
+        if self.memory_tracker is not None:
+            summary.update(self.memory_tracker.summary())
+        return summary
 
     def tune_hyperparams(self, cur_day):
         # Implement this in your portfolio if you want to tune
         raise 'tune_hyperparams is an abstract method, so it must be implemented by the child class!'
 
-    def update(self, cur_day, init=False):
+    def is_tune_day(self, cur_day):
+        """
+        :return: True if update tunes the hyperparameters on |cur_day|
+        """
+        if not self.tune_interval or self.repeat_past:
+            return False
+        return cur_day > self.start and cur_day % self.tune_interval == 1
+
+    def update(self, cur_day, init=False, tune=True):
         """
         Update the portfolio
 
         :param cur_day: 0-based index of today's date
         :param init: If True, this portfolio is being initialized today.
+        :param tune: If False, don't tune the hyperparameters today even if it's a tuning day
+        (e.g. when there's no time for it, see ExpertPool.enable_deadline).
         :return: None
         """
 
-        # Check if we need to tune hyperparameters today
-        if self.tune_interval and not self.repeat_past:
-            if cur_day > self.start and cur_day % self.tune_interval == 1:
-                self.tune_hyperparams(cur_day)
+        timer = self.timer
+
+        with tracing.span('update', portfolio=self.__class__.__name__, day=cur_day):
+            # Check if we need to tune hyperparameters today
+            if tune and self.is_tune_day(cur_day):
+                with tracing.span('tune_hyperparams', portfolio=self.__class__.__name__, day=cur_day):
+                    tune_start = default_timer()
+                    if self.memory_tracker is None:
+                        self.timed_tune_hyperparams(cur_day)
+                    else:
+                        self.memory_tracker.call('tune_hyperparams', cur_day, self.timed_tune_hyperparams, cur_day)
+                    self.last_tune_seconds = default_timer() - tune_start
+
+            self.update_allocation(cur_day, init)
+            if timer is None:
+                self.update_dollars(cur_day)
+            else:
+                timer.call('update_dollars', cur_day, self.update_dollars, cur_day)
+            self.last_day = cur_day
+
+        return
 
-        self.update_allocation(cur_day, init)
-        self.update_dollars(cur_day)
+    def hold(self, cur_day):
+        """
+        Cheap alternative to update: keep the current allocation through |cur_day| and only do the
+        accounting (no tuning and no new allocation). ExpertPool uses this for experts whose weight is
+        too low to be worth the full update (see ExpertPool hold_threshold).
+
+        :param cur_day: 0-based index of today's date (can't be the first simulated day)
+        :return: None
+        """
+        if self.last_day is None:
+            raise Exception('Can\'t hold a portfolio on its first day (it has no allocation yet).')
+
+        with tracing.span('hold', portfolio=self.__class__.__name__, day=cur_day):
+            if self.timer is None:
+                self.update_dollars(cur_day)
+            else:
+                self.timer.call('update_dollars', cur_day, self.update_dollars, cur_day)
+            self.last_day = cur_day
 
         return
 
+    def timed_tune_hyperparams(self, cur_day):
+        if self.timer is None:
+            self.tune_hyperparams(cur_day)
+        else:
+            self.timer.call('tune_hyperparams', cur_day, self.tune_hyperparams, cur_day)
+
     def update_allocation(self, cur_day, init=False):
         """
 
@@ -120,78 +308,164 @@ class Portfolio(object):
             # TODO: need to use special flags to indicate hold when using Yanjun's framework.
             return
 
-        self.b = self.get_new_allocation(cur_day, init)
+        if self.memory_tracker is None:
+            self.b = self.timed_get_new_allocation(cur_day, init)
+        else:
+            self.b = self.memory_tracker.call('get_new_allocation', cur_day, self.timed_get_new_allocation,
+                                              cur_day, init)
         return
 
+    def timed_get_new_allocation(self, cur_day, init=False):
+        if self.timer is None:
+            return self.get_new_allocation(cur_day, init)
+        return self.timer.call('get_new_allocation', cur_day, self.get_new_allocation, cur_day, init)
+
     def get_new_allocation(self, cur_day, init=False):
         raise 'get_new_allocation is an abstract method, so it must be implemented by the child class!'
 
+    @staticmethod
+    def predict_performance(allocations, est_cl):
+        """
+        Predict how much each dollar invested according to each allocation is worth after a day.
+
+        :param allocations: Allocation (num_stocks) or stacked allocations (num_portfolios x num_stocks),
+        e.g. ExpertPool.expert_b
+        :param est_cl: Estimated closing price relatives of each stock (e.g. from util.predict_prices)
+        :return: Predicted value per dollar of each allocation (a single matrix product)
+        """
+        return np.dot(allocations, est_cl)
+
 
     def update_dollars(self, cur_day):
         """
+        Let the holdings grow over |cur_day|, then rebalance to self.b at the closing prices.
 
-        :param op:
-        :param cl:
-        :param cur_dollars: Dollars before trading (at the open prices)
-        :return:
+        All of the work happens in the buffers from init_work_buffers (see AccountingStep).
+
+        :param cur_day: 0-based index of today's date
+        :return: None
         """
 
         day_idx = cur_day - self.start  # DON'T use this for accessing market data (use absolute date for market data)
 
-        prev_cl = self.last_close_price
-        op = self.data.get_op(relative=False)[cur_day, :]
-        cl = self.data.get_cl(relative=False)[cur_day, :]
-        new_portfolio = self.b
+        cl = self._cl[cur_day]
+        isActive = self._active[cur_day]
+        value_vec = self._value_vec
 
         # Get the value of our portfolio at the end of Day t before paying transaction costs
-        isActive = np.isfinite(op)
-        value_vec = self.dollars_op_history[day_idx] * self.b_history[:, day_idx]
-        growth = cl[isActive] / prev_cl[isActive]-1
-        growth[np.isnan(growth)] = 0
-        revenue_vec = value_vec[isActive] * growth
-        value_vec[isActive] = value_vec[isActive] + revenue_vec
-        self.dollars_cl_history[day_idx] = self.dollars_op_history[day_idx] + np.sum(revenue_vec)
+        np.multiply(self.b_history[:, day_idx], self.dollars_op_history[day_idx], out=value_vec)
+        revenue = self._accounting.grow(value_vec, cl, self.last_close_price, isActive)
+        self.dollars_cl_history[day_idx] = self.dollars_op_history[day_idx] + revenue
 
         # At the end of Day t, we use the close price of day t to adjust our
         # portfolio to the desired percentage.
         if day_idx <= self.num_days-2:
-            nonActive = np.logical_not(isActive)
-            value_realizable = self.dollars_cl_history[day_idx] - np.sum(value_vec[nonActive])
-            new_value_vec, trans_cost = util.rebalance(value_vec[isActive], value_realizable,
-                                                       new_portfolio[isActive])
-
+            trans_cost = self._accounting.rebalance(value_vec, self.dollars_cl_history[day_idx], isActive,
+                                                    self._inactive[cur_day], self.b)
             self.dollars_op_history[day_idx+1] = self.dollars_cl_history[day_idx] - trans_cost
-            value_vec[isActive] = new_value_vec
-            self.b_history[:, day_idx+1] = value_vec / self.dollars_op_history[day_idx+1]
+            np.divide(value_vec, self.dollars_op_history[day_idx+1], out=self.b_history[:, day_idx+1])
 
-        self.last_close_price[isActive] = cl[isActive]
+        np.copyto(self.last_close_price, cl, where=isActive)
         return
 
-    def run(self, start=None, stop=None):
+    def run(self, start=None, stop=None, checkpoint_path=None, checkpoint_interval=None):
         """
+        If a result cache is enabled (see enable_result_cache), the result is restored from the cache when
+        the same run has been done before. Runs with checkpoints are never cached.
 
         :param start:
         :param stop:
+        :param checkpoint_path: File to save checkpoints to (see save_checkpoint).
+        :param checkpoint_interval: Save a checkpoint every |checkpoint_interval| days.
         :return: None
         """
 
+        self.check_checkpoint_args(checkpoint_path, checkpoint_interval)
         if start is None:
             start = self.start
         if stop is None:
             stop = self.stop
 
-        for day in range(start, stop):
-            if day == start:
-                init = True
-            else:
-                init = False
-            self.update(day, init)
+        key = None
+        if self.result_cache is not None and checkpoint_path is None:
+            key = self.result_cache.make_key(self, start, stop)
+        if key is not None:
+            state = self.result_cache.get(key)
+            if state is not None:
+                self.set_cache_state(state)
+                self.report_results()
+                return
+
+        self.run_days(start, stop, True, checkpoint_path, checkpoint_interval)
+        if key is not None:
+            self.result_cache.put(key, self.get_cache_state())
+
+    def resume(self, checkpoint_path, stop=None, checkpoint_interval=None):
+        """
+        Restore the state saved in |checkpoint_path| and continue running from the day after the checkpoint.
+        Keeps saving checkpoints to the same file if |checkpoint_interval| is given.
+
+        :param checkpoint_path: File written by save_checkpoint
+        :param stop:
+        :param checkpoint_interval:
+        :return: None
+        """
+
+        self.check_checkpoint_args(checkpoint_path, checkpoint_interval)
+        self.load_checkpoint(checkpoint_path)
+        if stop is None:
+            stop = self.stop
+
+        self.run_days(self.last_day + 1, stop, False, checkpoint_path, checkpoint_interval)
+
+    @staticmethod
+    def check_checkpoint_args(checkpoint_path, checkpoint_interval):
+        if checkpoint_interval is None:
+            return
+        if checkpoint_path is None:
+            raise Exception('checkpoint_interval was given without a checkpoint_path to save the checkpoints to.')
+        if checkpoint_interval < 1:
+            raise Exception('checkpoint_interval must be a positive number of days (got ' + str(checkpoint_interval) + ').')
+
+    def run_days(self, start, stop, init, checkpoint_path=None, checkpoint_interval=None):
+        """
+        Simulate the days from |start| to |stop| and report the results.
+
+        :param init: If True, the portfolio is initialized on the first day.
+        """
+
+        with tracing.span('run', portfolio=self.__class__.__name__, start=start, stop=stop):
+            for day in range(start, stop):
+                self.update(day, init and day == start)
+                if checkpoint_interval and (day - start + 1) % checkpoint_interval == 0:
+                    self.save_checkpoint(checkpoint_path)
+        self.finish_run()
+        self.report_results()
+
+    def report_results(self):
+        """
+        Compute the Sharpe ratio and the timing and memory summaries, print them and save the results.
+        """
         self.sharpe = empirical_sharpe_ratio(self.dollars_op_history)
+        if self.timer is not None:
+            self.timing_summary = self.get_timing_summary()
+        if self.memory_tracker is not None:
+            self.memory_summary = self.get_memory_summary()
 
         self.print_results()
         if self.new_results_dir is not None:
             self.save_results()
+            if self.timing_summary is not None:
+                save_summary(self.new_results_dir + 'timing.json', self.timing_summary)
+            if self.memory_summary is not None:
+                save_summary(self.new_results_dir + 'memory.json', self.memory_summary)
 
+    def finish_run(self):
+        """
+        Called after the last simulated day of run or resume, before the results are reported. Child classes
+        can override this to clean up (e.g. ExpertPool stops its worker processes).
+        """
+        pass
 
     def print_results(self):
         if self.verbose:
@@ -211,25 +485,118 @@ class Portfolio(object):
         print 'Saving ', self.portfolio_type
         save_dir = self.new_results_dir
 
-        util.save_dollars_history(save_dir=save_dir, dollars=self.dollars_op_history, portfolio_type=self.portfolio_type)
-        full_b = np.concatenate((self.b_history, self.b.reshape(-1, 1)), axis=1)
-        util.save_b_history(save_dir=save_dir, b_history=full_b, portfolio_type=self.portfolio_type)
-        util.save_hyperparams(save_dir=save_dir, hyperparams_dict=self.get_hyperparams_dict(), portfolio_type=self.portfolio_type)
+        hyperparams_dict = self.get_hyperparams_dict()
+        final_b = np.reshape(self.b, (-1, 1))
+        if isinstance(self.b_history, StreamingHistory):
+            # Assemble b_history.npy from the streamed chunks without loading the full history
+            util.save_binary_results(save_dir=save_dir, portfolio_type=self.portfolio_type, dollars=self.dollars_op_history,
+                                     hyperparams_dict=hyperparams_dict, start=self.start, stop=self.stop)
+            self.b_history.save(save_dir + 'b_history.npy', extra_cols=final_b)
+            full_b = np.load(save_dir + 'b_history.npy', mmap_mode='r')
+        else:
+            full_b = np.concatenate((self.b_history, final_b), axis=1)
+            util.save_binary_results(save_dir=save_dir, portfolio_type=self.portfolio_type, dollars=self.dollars_op_history,
+                                     b_history=full_b, hyperparams_dict=hyperparams_dict, start=self.start, stop=self.stop)
+
+        if self.save_allocation_file:
+            # Day-major copy of the allocations for constant time lookup of any day (see allocation_file.py)
+            save_allocations(save_dir + 'allocations.npy', full_b)
+        util.save_hyperparams(save_dir=save_dir, hyperparams_dict=hyperparams_dict, portfolio_type=self.portfolio_type)
         return
 
     def get_hyperparams_dict(self):
         raise 'Abstract method. Implement in the child class.'
 
     def load_previous_results(self, past_results_dir):
+        """
+        Load the past portfolio and dollars histories. Binary results (see util.save_binary_results) are
+        memory mapped. Directories that only contain the old text format are parsed with np.loadtxt
+        (use convert_results.py to convert them).
+        """
 
-        # Load past dollars history
-        past_dollars_op_history = np.loadtxt(past_results_dir + 'dollars_history.txt', delimiter='\t')
+        if util.has_binary_results(past_results_dir):
+            past_b_history, past_dollars_op_history, _ = util.load_binary_results(past_results_dir)
+        else:
+            past_b_history, past_dollars_op_history = util.load_text_results(past_results_dir)
 
-        # Load past portfolio history
-        past_b_history = np.loadtxt(past_results_dir + 'b_history.txt', delimiter='\t')
+        if past_b_history is None:
+            raise Exception('No portfolio history found in ' + past_results_dir)
 
         return past_b_history, past_dollars_op_history
 
+    def get_state(self):
+        """
+        Get everything needed to continue the simulation from the last simulated day. Child classes
+        with extra state should add it to this dictionary and restore it in set_state.
+
+        :return: Dictionary mapping names to arrays or scalars
+        """
+        state = {
+            'dollars_op_history': self.dollars_op_history,
+            'dollars_cl_history': self.dollars_cl_history,
+            'last_close_price': self.last_close_price,
+        }
+        if isinstance(self.b_history, StreamingHistory):
+            for key, val in self.b_history.get_state().iteritems():
+                state['b_history.' + key] = val
+        else:
+            state['b_history'] = self.b_history
+        if self.b is not None:
+            state['b'] = self.b
+        if self.last_day is not None:
+            state['last_day'] = self.last_day
+        return state
+
+    def get_cache_state(self):
+        """
+        :return: The state to store in the result cache after a run (see enable_result_cache)
+        """
+        if self.cache_dollars_only:
+            return {'dollars_op_history': self.dollars_op_history, 'dollars_cl_history': self.dollars_cl_history}
+        return self.get_state()
+
+    def set_cache_state(self, state):
+        """
+        Restore the state returned by get_cache_state.
+        """
+        if self.cache_dollars_only:
+            self.dollars_op_history[...] = state['dollars_op_history']
+            self.dollars_cl_history[...] = state['dollars_cl_history']
+        else:
+            self.set_state(state)
+
+    def set_state(self, state):
+        """
+        Restore the state returned by get_state. Arrays are copied into the existing arrays.
+        """
+        if isinstance(self.b_history, StreamingHistory):
+            prefix = 'b_history.'
+            self.b_history.set_state(dict((key[len(prefix):], val) for key, val in state.iteritems()
+                                          if key.startswith(prefix)))
+        else:
+            self.b_history[...] = state['b_history']
+        self.dollars_op_history[...] = state['dollars_op_history']
+        self.dollars_cl_history[...] = state['dollars_cl_history']
+        self.last_close_price[...] = state['last_close_price']
+        if 'b' in state:
+            self.b = np.array(state['b'])
+        if 'last_day' in state:
+            self.last_day = int(state['last_day'])
+
+    def save_checkpoint(self, path):
+        """
+        Save the complete simulation state to the binary file |path| (.npz format, so |path| should end in .npz).
+        """
+        np.savez_compressed(path, **self.get_state())
+
+    def load_checkpoint(self, path):
+        """
+        Restore the simulation state from a file written by save_checkpoint.
+        """
+        checkpoint = np.load(path)
+        self.set_state(dict((key, checkpoint[key]) for key in checkpoint.files))
+        checkpoint.close()
+
     """
     Getters
     """
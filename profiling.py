@@ -0,0 +1,190 @@
+"""
+    Instrumentation for finding out where a backtest spends its time and memory.
+
+"""
+
+import ctypes
+import json
+import resource
+import sys
+from timeit import default_timer
+import numpy as np
+
+try:
+    import tracemalloc  # Only available in Python 3
+except ImportError:
+    tracemalloc = None
+
+# Histogram bin edges (in milliseconds) shared by every phase: 1 us to 100 s in half decades
+hist_bin_edges_ms = 10.0 ** np.arange(-3, 5.5, 0.5)
+
+
+class PhaseTimer(object):
+    """
+    Records the wall time spent in each phase (e.g. tune_hyperparams, get_new_allocation,
+    update_dollars) on each day of a run.
+    """
+
+    def __init__(self):
+        self.durations = {}  # phase -> list of durations (seconds)
+        self.days = {}  # phase -> list of the days the durations were recorded on
+
+    def record(self, phase, day, seconds):
+        if phase not in self.durations:
+            self.durations[phase] = []
+            self.days[phase] = []
+        self.durations[phase].append(seconds)
+        self.days[phase].append(day)
+
+    def call(self, phase, day, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) and record how long it took as |phase| on |day|.
+
+        :return: The return value of func
+        """
+        start_time = default_timer()
+        result = func(*args, **kwargs)
+        self.record(phase, day, default_timer() - start_time)
+        return result
+
+    def summary(self):
+        """
+        :return: Dictionary mapping each phase to its statistics (in milliseconds), the histogram of its
+        durations (counts for the bins in hist_bin_edges_ms) and the slowest day.
+        """
+        phases = {}
+        for phase, durations in self.durations.iteritems():
+            durations_ms = 1000.0 * np.array(durations)
+            counts, _ = np.histogram(durations_ms, bins=hist_bin_edges_ms)
+            slowest = int(np.argmax(durations_ms))
+            phases[phase] = {
+                'count': len(durations_ms),
+                'total_ms': float(np.sum(durations_ms)),
+                'mean_ms': float(np.mean(durations_ms)),
+                'p50_ms': float(np.percentile(durations_ms, 50)),
+                'p99_ms': float(np.percentile(durations_ms, 99)),
+                'max_ms': float(durations_ms[slowest]),
+                'slowest_day': int(self.days[phase][slowest]),
+                'hist_counts': counts.tolist(),
+            }
+        return {'hist_bin_edges_ms': hist_bin_edges_ms.tolist(), 'phases': phases}
+
+
+def peak_rss_bytes():
+    """
+    :return: Peak resident set size of this process so far (bytes)
+    """
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return max_rss  # Already in bytes on OS X
+    return 1024 * max_rss  # Kilobytes on Linux
+
+
+def trim_heap():
+    """
+    Give the free memory of the heap back to the OS (glibc only). Memory that is allocated afterwards has to be
+    paged in again, even if malloc reuses freed blocks, so it shows up in minor_page_faults.
+
+    :return: Whether the heap was trimmed
+    """
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError):
+        return False
+    return True
+
+
+def minor_page_faults():
+    """
+    :return: Number of minor page faults of this process so far (pages of memory it touched for the first time)
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+
+def array_nbytes(*arrays):
+    """
+    :return: Bytes held in memory by the given arrays. None entries and memory maps (which live on disk) count
+    as 0. Objects like StreamingHistory and RollingSharpe report their own usage through an nbytes property,
+    like ndarray.
+    """
+    total = 0
+    for arr in arrays:
+        if arr is None or isinstance(arr, np.memmap):
+            continue
+        total += arr.nbytes
+    return total
+
+
+class MemoryTracker(object):
+    """
+    Records how much memory each call of a phase (e.g. tune_hyperparams, get_new_allocation) needed:
+        - rss_delta: How much the call raised the peak RSS of the process. This is 0 if the call stayed
+          under an earlier peak, so the first large events are the informative ones.
+        - traced_delta: Peak traced allocation during the call minus the traced memory before it. Only
+          recorded if tracemalloc is tracing and can reset its peak (Python 3.9+, run with -X tracemalloc).
+    """
+
+    def __init__(self):
+        self.rss_deltas = {}  # phase -> list of peak RSS increases (bytes)
+        self.traced_deltas = {}  # phase -> list of peak traced allocations (bytes, None if not tracing)
+        self.days = {}  # phase -> list of the days the deltas were recorded on
+
+    def record(self, phase, day, rss_delta, traced_delta=None):
+        if phase not in self.rss_deltas:
+            self.rss_deltas[phase] = []
+            self.traced_deltas[phase] = []
+            self.days[phase] = []
+        self.rss_deltas[phase].append(rss_delta)
+        self.traced_deltas[phase].append(traced_delta)
+        self.days[phase].append(day)
+
+    def call(self, phase, day, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) and record its memory deltas as |phase| on |day|.
+
+        :return: The return value of func
+        """
+        tracing = tracemalloc is not None and tracemalloc.is_tracing() and hasattr(tracemalloc, 'reset_peak')
+        if tracing:
+            traced_before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        rss_before = peak_rss_bytes()
+
+        result = func(*args, **kwargs)
+
+        traced_delta = None
+        if tracing:
+            traced_delta = tracemalloc.get_traced_memory()[1] - traced_before
+        self.record(phase, day, peak_rss_bytes() - rss_before, traced_delta)
+        return result
+
+    def summary(self):
+        """
+        :return: Dictionary with the peak RSS of the process and, for each phase, the number of calls and the
+        largest deltas (with the day they happened on)
+        """
+        phases = {}
+        for phase, rss_deltas in self.rss_deltas.iteritems():
+            largest = int(np.argmax(rss_deltas))
+            phases[phase] = {
+                'count': len(rss_deltas),
+                'max_rss_delta_bytes': int(rss_deltas[largest]),
+                'max_rss_delta_day': int(self.days[phase][largest]),
+                'total_rss_delta_bytes': int(np.sum(rss_deltas)),
+            }
+            traced = [(delta, day) for (delta, day) in zip(self.traced_deltas[phase], self.days[phase])
+                      if delta is not None]
+            if traced:
+                max_delta, max_day = max(traced)
+                phases[phase]['max_traced_delta_bytes'] = int(max_delta)
+                phases[phase]['max_traced_delta_day'] = int(max_day)
+        return {'peak_rss_bytes': peak_rss_bytes(), 'phases': phases}
+
+
+def save_summary(path, summary):
+    """
+    Write a run summary (e.g. from Portfolio.get_timing_summary or get_memory_summary) to |path| as JSON.
+    """
+    out_file = open(path, 'w')
+    json.dump(summary, out_file, indent=2, sort_keys=True)
+    out_file.close()
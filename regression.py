@@ -0,0 +1,257 @@
+"""
+    Regression gate for refactoring the strategies.
+
+    Replays each strategy on data/market_data_train.mat and compares dollars_op_history,
+    the Sharpe ratio and b_history against golden outputs stored in regression_golden/,
+    and the wall time of the run against the stored baseline time. Exits with status 1
+    if any output differs by more than the tolerance or any run is more than
+    --max-slowdown times slower than its baseline.
+
+    Each case is timed as the fastest of --repeats runs. The baseline times are recorded
+    together with the time of a fixed numpy calibration workload, and are scaled by how
+    much slower or faster that workload runs now, so that a busy or different machine
+    doesn't fail the gate on unchanged code. Cases that can't run here (e.g. NPM without
+    cvxpy) are listed as warnings in the summary. The gate also runs the memory checks of
+    check_memory.py.
+
+    Usage:
+        python regression.py                    # Check against the golden outputs
+        python regression.py --update           # Record new golden outputs and baseline times
+        python regression.py --update-timings   # Only record new baseline times (e.g. on a new machine)
+
+"""
+
+import argparse
+import os
+import sys
+from timeit import default_timer
+import numpy as np
+import check_memory
+from benchmark import strategies
+from util import load_matlab_sp500_data
+
+default_data_path = 'data/market_data_train.mat'
+default_golden_dir = 'regression_golden/'
+calibration_size = 250
+
+# (strategy in benchmark.strategies, tune interval) of each regression case
+regression_cases = [
+    ('UCRP', None),
+    ('UBAH', None),
+    ('OLMAR', None),
+    ('OLMAR', 10),
+    ('RMR', None),
+    ('RMR', 10),
+    ('NPM', None),
+    ('EP', None),
+]
+
+
+def case_name(strategy, tune_interval):
+    if tune_interval is None:
+        return strategy
+    return strategy + '_tune' + str(tune_interval)
+
+
+def calibrate(repeats=10):
+    """
+    Time a fixed workload of the numpy operations that dominate the strategies (the fastest of
+    |repeats| runs), as a measure of how fast this machine is right now.
+
+    :return: Wall time in seconds
+    """
+    rand = np.random.RandomState(0)
+    mat = rand.rand(calibration_size, calibration_size)
+    vec = rand.rand(calibration_size)
+    best_seconds = None
+    for _ in range(repeats):
+        start_time = default_timer()
+        for _ in range(20):
+            prod = np.dot(mat, mat)
+            np.divide(prod, prod.sum(axis=0), out=prod)
+            vec = np.dot(prod, vec)
+            vec /= vec.sum()
+        seconds = default_timer() - start_time
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return best_seconds
+
+
+def run_case(strategy, tune_interval, market_data, repeats=1):
+    """
+    Run the case |repeats| times.
+
+    :return: (Portfolio of the last run, fastest wall time in seconds), or (None, reason) if the strategy
+    can't run here (e.g. NPM without cvxpy)
+    """
+    make_portfolio, _ = strategies[strategy]
+    best_seconds = None
+    portfolio = None
+    for _ in range(repeats):
+        try:
+            portfolio = make_portfolio(market_data, tune_interval)
+        except ImportError as e:
+            return None, str(e)
+        start_time = default_timer()
+        portfolio.run()
+        seconds = default_timer() - start_time
+        if best_seconds is None or seconds < best_seconds:
+            best_seconds = seconds
+    return portfolio, best_seconds
+
+
+def get_outputs(portfolio):
+    return {
+        'dollars_op_history': np.asarray(portfolio.dollars_op_history),
+        'sharpe': np.array(portfolio.sharpe),
+        'b_history': np.asarray(portfolio.b_history),
+    }
+
+
+def golden_path(golden_dir, name):
+    return os.path.join(golden_dir, name + '.npz')
+
+
+def save_golden(golden_dir, name, outputs, seconds, calibration_seconds):
+    if not os.path.exists(golden_dir):
+        os.makedirs(golden_dir)
+    np.savez_compressed(golden_path(golden_dir, name), seconds=np.array(seconds),
+                        calibration_seconds=np.array(calibration_seconds), **outputs)
+
+
+def load_golden(golden_dir, name):
+    """
+    :return: Dictionary with the golden outputs, baseline 'seconds' and 'calibration_seconds' (see calibrate,
+    missing in golden files recorded before calibration existed), or None if there is no golden file
+    """
+    path = golden_path(golden_dir, name)
+    if not os.path.exists(path):
+        return None
+    golden_file = np.load(path)
+    golden = dict((key, golden_file[key]) for key in golden_file.files)
+    golden_file.close()
+    return golden
+
+
+def compare_outputs(outputs, golden, rtol, atol):
+    """
+    :return: List of failure messages (empty if every output matches the golden output within tolerance)
+    """
+    failures = []
+    for key in sorted(outputs.keys()):
+        actual = outputs[key]
+        expected = golden[key]
+        if actual.shape != expected.shape:
+            failures.append('%s has shape %s, expected %s' % (key, actual.shape, expected.shape))
+            continue
+        close = np.isclose(actual, expected, rtol=rtol, atol=atol) | (np.isnan(actual) & np.isnan(expected))
+        if not np.all(close):
+            with np.errstate(invalid='ignore'):
+                max_diff = np.nanmax(np.abs(actual - expected))
+            failures.append('%s differs at %d entries (max abs diff %g)' % (key, np.sum(~close), max_diff))
+    return failures
+
+
+def compare_timing(seconds, baseline_seconds, max_slowdown, min_seconds, speed_ratio=1.0):
+    """
+    Runs faster than |min_seconds| are compared against |min_seconds|, so that timer noise on tiny runs
+    doesn't fail the gate.
+
+    :param speed_ratio: Calibration time now / calibration time when the baseline was recorded. The baseline
+    is scaled by it.
+    :return: List of failure messages
+    """
+    ratio = seconds / max(baseline_seconds * speed_ratio, min_seconds)
+    if ratio > max_slowdown:
+        return ['%.3f s is %.2fx the baseline of %.3f s (machine speed %.2fx, max %.2fx)'
+                % (seconds, ratio, baseline_seconds, speed_ratio, max_slowdown)]
+    return []
+
+
+def run_regression(market_data, golden_dir, update=False, update_timings=False, rtol=1e-9, atol=1e-12,
+                   max_slowdown=2.0, min_seconds=0.05, repeats=3, cases=regression_cases):
+    """
+    :return: (failures, warnings): dictionaries mapping case names to lists of failure messages, and to the
+    reason the case wasn't checked
+    """
+    failures = {}
+    warnings = {}
+    calibration_seconds = calibrate()
+    for strategy, tune_interval in cases:
+        name = case_name(strategy, tune_interval)
+        portfolio, seconds = run_case(strategy, tune_interval, market_data, repeats)
+        if portfolio is None:
+            warnings[name] = 'skipped: ' + seconds
+            print '%-14s SKIP %s' % (name, seconds)
+            continue
+        outputs = get_outputs(portfolio)
+        golden = load_golden(golden_dir, name)
+
+        if update or (update_timings and golden is not None):
+            if not update:
+                outputs = dict((key, golden[key]) for key in outputs.keys())
+            save_golden(golden_dir, name, outputs, seconds, calibration_seconds)
+            print '%-14s recorded (%.3f s)' % (name, seconds)
+            continue
+
+        if golden is None:
+            failures[name] = ['no golden output in ' + golden_path(golden_dir, name) + ' (run with --update)']
+        else:
+            speed_ratio = 1.0
+            if 'calibration_seconds' in golden:
+                speed_ratio = calibration_seconds / float(golden['calibration_seconds'])
+            else:
+                warnings[name] = 'baseline time has no calibration (run with --update-timings)'
+            failures[name] = compare_outputs(outputs, golden, rtol, atol) + \
+                compare_timing(seconds, float(golden['seconds']), max_slowdown, min_seconds, speed_ratio)
+
+        status = 'FAIL' if failures[name] else 'ok'
+        print '%-14s %-4s %.3f s' % (name, status, seconds)
+        for failure in failures[name]:
+            print '    ' + failure
+    return failures, warnings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check the strategies against golden outputs and baseline times.')
+    parser.add_argument('--data', default=default_data_path, help='Market data (.mat) to replay')
+    parser.add_argument('--golden-dir', default=default_golden_dir, help='Directory with the golden outputs')
+    parser.add_argument('--update', action='store_true', help='Record new golden outputs and baseline times')
+    parser.add_argument('--update-timings', action='store_true', help='Only record new baseline times')
+    parser.add_argument('--rtol', type=float, default=1e-9, help='Relative tolerance of the outputs')
+    parser.add_argument('--atol', type=float, default=1e-12, help='Absolute tolerance of the outputs')
+    parser.add_argument('--max-slowdown', type=float, default=2.0,
+                        help='Max ratio of run time to the (calibrated) baseline time')
+    parser.add_argument('--min-seconds', type=float, default=0.05,
+                        help='Baseline times below this are treated as this when checking the slowdown')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per case (the fastest one is timed)')
+    parser.add_argument('--cases', default=None,
+                        help='Comma separated cases to run, e.g. OLMAR,RMR_tune10 (default: all)')
+    args = parser.parse_args()
+
+    cases = regression_cases
+    if args.cases is not None:
+        names = args.cases.split(',')
+        cases = [case for case in regression_cases if case_name(*case) in names]
+        if len(cases) != len(names):
+            raise Exception('Unknown case. Cases: ' + ', '.join(case_name(*case) for case in regression_cases))
+
+    market_data = load_matlab_sp500_data(args.data)
+    failures, warnings = run_regression(market_data, args.golden_dir, update=args.update, update_timings=args.update_timings,
+                              rtol=args.rtol, atol=args.atol, max_slowdown=args.max_slowdown,
+                              min_seconds=args.min_seconds, repeats=args.repeats, cases=cases)
+    if not (args.update or args.update_timings):
+        memory_failures, memory_warnings = check_memory.run_checks()
+        failures.update(memory_failures)
+        warnings.update(memory_warnings)
+
+    num_failed = len([name for name in failures if failures[name]])
+    for name in sorted(warnings):
+        print 'WARNING: %s %s' % (name, warnings[name])
+    if args.update or args.update_timings:
+        print 'Recorded in', args.golden_dir
+    elif num_failed:
+        print num_failed, 'of', len(failures), 'regression cases and checks failed'
+        sys.exit(1)
+    else:
+        print 'All', len(failures), 'regression cases and checks passed'
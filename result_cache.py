@@ -0,0 +1,216 @@
+"""
+    Disk-backed cache of backtest results (see Portfolio.enable_result_cache).
+
+    Each result is the portfolio's state after the run (see Portfolio.get_cache_state), saved
+    compressed as <cache_dir>/<key>.npz. The key is a hash of everything that determines the run:
+    the strategy class, its hyperparameters (Portfolio.get_cache_params), the start and stop days,
+    the initial allocation, the market data (MarketData.fingerprint) and the code version (a hash
+    of the package's source files, so any code change invalidates the cache). The cache is bounded
+    by |max_bytes| on disk and evicts the least recently used results first. Each process keeps an
+    index of the sizes of the results, so the directory is only scanned when the cache is full.
+
+    Usage:
+        cache = ResultCache('results/cache/')
+        portfolio.enable_result_cache(cache)
+        portfolio.run()  # Restores the result if the same run is in the cache
+        print cache.get_stats()
+
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+import numpy as np
+from history_store import StreamingHistory
+
+_code_version = None
+
+# When the cache is full, the least recently used results are evicted until it's this full, so that
+# the following puts don't evict again right away
+evict_to_fraction = 0.9
+
+
+def hash_array(arr):
+    """
+    :return: Hex digest of the contents, shape and type of |arr| (or 'None')
+    """
+    if arr is None:
+        return 'None'
+    arr = np.ascontiguousarray(arr)
+    sha = hashlib.sha1(str(arr.dtype) + str(arr.shape))
+    sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+def code_version():
+    """
+    :return: Hex digest of the source files of this package (computed once per process)
+    """
+    global _code_version
+    if _code_version is None:
+        sha = hashlib.sha1()
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        for path in sorted(glob.glob(os.path.join(package_dir, '*.py'))):
+            with open(path, 'rb') as f:
+                sha.update(f.read())
+        _code_version = sha.hexdigest()
+    return _code_version
+
+
+class ResultCache(object):
+    """
+    Content-addressed store of portfolio states with LRU eviction and hit/miss statistics.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        """
+        :param cache_dir: Directory of the cached results (shared by every process using the cache)
+        :param max_bytes: Max total size of the cached results on disk
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        self.index = None  # key -> (last use time, size in bytes) of each cached result (loaded on first put)
+        self.total_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.puts = 0
+        self.evictions = 0
+
+    def make_key(self, portfolio, start, stop):
+        """
+        :return: Key of running |portfolio| from |start| to |stop|, or None if the run can't be cached
+        (e.g. its results depend on timing, or its history is streamed to disk)
+        """
+        params = portfolio.get_cache_params()
+        if params is None or isinstance(portfolio.b_history, StreamingHistory):
+            return None
+
+        key_dict = {
+            'strategy': portfolio.__class__.__module__ + '.' + portfolio.__class__.__name__,
+            'params': params,
+            'start': start,
+            'stop': stop,
+            'portfolio_start': portfolio.start,
+            'portfolio_stop': portfolio.stop,
+            'init_b': hash_array(portfolio.b),
+            'dollars_only': portfolio.cache_dollars_only,
+            'market_data': portfolio.data.fingerprint(),
+            'code_version': code_version(),
+        }
+        return hashlib.sha1(json.dumps(key_dict, sort_keys=True, default=str)).hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        :return: The cached state of |key|, or None on a miss
+        """
+        path = self.get_path(key)
+        try:
+            cached = np.load(path)
+            state = dict((name, cached[name]) for name in cached.files)
+            cached.close()
+        except (IOError, OSError):
+            # Missing (or evicted by another process while loading)
+            self.misses += 1
+            return None
+
+        os.utime(path, None)  # Mark as recently used
+        if self.index is not None:
+            self.add_to_index(key, os.path.getsize(path))
+        self.hits += 1
+        return state
+
+    def put(self, key, state):
+        """
+        Save |state| under |key|. If the cache no longer fits in max_bytes, evict the least recently used
+        results (see evict).
+        """
+        # Write to a temporary file first, so that other processes never load a partial result
+        tmp_path = os.path.join(self.cache_dir, key + '.tmp' + str(os.getpid()) + '.npz')
+        np.savez_compressed(tmp_path, **state)
+        size = os.path.getsize(tmp_path)
+        os.rename(tmp_path, self.get_path(key))
+        self.puts += 1
+
+        if self.index is None:
+            self.load_index()
+        self.add_to_index(key, size)
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def add_to_index(self, key, size):
+        if key in self.index:
+            self.total_bytes -= self.index[key][1]
+        self.index[key] = (time.time(), size)
+        self.total_bytes += size
+
+    def load_index(self):
+        """
+        Rebuild the index from the cache directory (other processes may have added or evicted results).
+        """
+        self.index = {}
+        for (last_use, size, path) in self.get_entries():
+            self.index[os.path.basename(path)[:-len('.npz')]] = (last_use, size)
+        self.total_bytes = sum(size for (_, size) in self.index.itervalues())
+
+    def get_entries(self):
+        """
+        :return: List of (last use time, size in bytes, path) of the cached results, least recently used first
+        """
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            if '.tmp' in os.path.basename(path):
+                continue
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """
+        Evict the least recently used results until the cache is at most evict_to_fraction full.
+        """
+        self.load_index()
+        for (_, size, key) in sorted((last_use, size, key) for (key, (last_use, size)) in self.index.iteritems()):
+            if self.total_bytes <= evict_to_fraction * self.max_bytes:
+                break
+            try:
+                os.remove(self.get_path(key))
+                self.evictions += 1
+            except OSError:
+                pass  # Already evicted by another process
+            del self.index[key]
+            self.total_bytes -= size
+
+    def clear(self):
+        for (_, _, path) in self.get_entries():
+            os.remove(path)
+        self.index = {}
+        self.total_bytes = 0
+
+    def get_stats(self):
+        """
+        :return: Dictionary with the hits, misses, puts and evictions of this process, the hit rate, and
+        the number of results and bytes in the cache
+        """
+        entries = self.get_entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else None,
+            'puts': self.puts,
+            'evictions': self.evictions,
+            'num_entries': len(entries),
+            'bytes': sum(size for (_, size, _) in entries),
+        }
@@ -1,5 +1,6 @@
 import itertools
 import numpy as np
+import tracing
 import util
 from portfolio import Portfolio
 from olmar import OLMAR
@@ -96,7 +97,8 @@ class RMR(OLMAR):
 
         for i in range(1, self.max_iter):
             prev_mu = mu_avail_full_window
-            mu_avail_full_window = self.T_func(mu_avail_full_window, window_pr_avail_full_window)
+            with tracing.span('T_func', iteration=i):
+                mu_avail_full_window = self.T_func(mu_avail_full_window, window_pr_avail_full_window)
             L1_dist = np.linalg.norm((prev_mu-mu_avail_full_window), ord=1)
             thresh = self.tau * np.linalg.norm(mu_avail_full_window, ord=1)
 
@@ -171,10 +173,7 @@ class RMR(OLMAR):
         # Compute sharpe ratios for each setting of hyperparams
         sharpe_ratios = []
         for (win, eps) in hyp_combos:
-            cur_portfolio = RMR(market_data=self.data, start=start_day, stop=cur_day,
-                                  init_b=init_b, window=win, eps=eps, tune_interval=None, verbose=False, silent=True)
-            cur_portfolio.run(start_day, cur_day)
-            cur_dollars_history = cur_portfolio.get_dollars_history()
+            cur_dollars_history = self.backtest_candidate(win, eps, start_day, cur_day, init_b)
             sharpe_ratios.append(util.empirical_sharpe_ratio(cur_dollars_history))
 
         best_window, best_eps = hyp_combos[sharpe_ratios.index(max(sharpe_ratios))]
@@ -189,18 +188,20 @@ class RMR(OLMAR):
             print 30 * '-'
         Portfolio.print_results(self)
 
-    def save_results(self):
-        print 'saving RMR'
-        save_dir = self.new_results_dir
+    def get_state(self):
+        state = super(RMR, self).get_state()
+        state['tau'] = self.tau
+        return state
 
-        # Dollars History File
-        util.save_dollars_history(save_dir=save_dir, dollars=self.dollars_op_history, portfolio_type='RMR')
+    def set_state(self, state):
+        super(RMR, self).set_state(state)
+        self.tau = float(state['tau'])
 
-        # Portfolio Allocation History File
-        util.save_b_history(save_dir=save_dir, b_history=self.b_history, portfolio_type='RMR')
-
-        # Hyperparameters File
-        util.save_hyperparams(save_dir=save_dir, hyperparams_dict=self.get_hyperparams_dict(), portfolio_type='RMR')
+    def get_cache_params(self):
+        params = super(RMR, self).get_cache_params()
+        params['tau'] = float(self.tau)
+        params['max_iter'] = self.max_iter
+        return params
 
     def get_hyperparams_dict(self):
         hyperparams = {
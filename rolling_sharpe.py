@@ -0,0 +1,100 @@
+import numpy as np
+
+# Number of trading days per year used to annualize the Sharpe ratio (as in util.empirical_sharpe_ratio)
+days_per_year = 252
+
+
+class RollingSharpe(object):
+    """
+    Sharpe ratios of any window of several dollar histories in O(1) per window.
+
+    Each history is the concatenation of an optional past history (e.g. from training) and a new
+    history that fills in one day at a time. Day t of the combined timeline is new[t] for t >= 0 and
+    past[t] (counting from the end) for t < 0. As in ExpertPool, the past history is treated as if it
+    were scaled to end with new[0], so the log return into day 0 is 0. Prefix sums of the log returns
+    and squared log returns over the combined timeline give the sums over any window as a difference.
+    """
+
+    def __init__(self, new_histories, past_histories=None):
+        """
+        :param new_histories: (num_series x num_days) matrix with the dollar history of each series. It's
+        read as days are added, so it must be updated in place.
+        :param past_histories: Past dollar history of each series (all of the same length), or None
+        """
+        self.new_histories = new_histories
+        self.num_series, num_days = new_histories.shape
+
+        if past_histories is None:
+            self.len_past = 0
+        else:
+            past = np.array([np.asarray(hist, dtype=float) for hist in past_histories])
+            if past.ndim != 2 or past.shape[0] != self.num_series:
+                raise Exception('RollingSharpe needs 1 past history of the same length for each series.')
+            self.len_past = past.shape[1]
+
+        # sums[:, k] = Sum of the log returns into days -len_past+1, ..., k-len_past of the combined timeline
+        self.sums = np.zeros((self.num_series, self.len_past + num_days))
+        self.sq_sums = np.zeros((self.num_series, self.len_past + num_days))
+        if self.len_past > 1:
+            past_returns = np.log(past[:, 1:] / past[:, :-1])
+            np.cumsum(past_returns, axis=1, out=self.sums[:, 1:self.len_past])
+            np.cumsum(past_returns ** 2, axis=1, out=self.sq_sums[:, 1:self.len_past])
+
+        # Log return into day 0 is 0
+        if self.len_past > 0:
+            self.sums[:, self.len_past] = self.sums[:, self.len_past - 1]
+            self.sq_sums[:, self.len_past] = self.sq_sums[:, self.len_past - 1]
+        self.num_filled = 1  # Number of days of the new histories added to the sums
+
+    def advance(self, stop):
+        """
+        Add the days of the new histories before |stop| to the sums (reading each day only once).
+        """
+        if stop <= self.num_filled:
+            return
+        start = self.num_filled
+        dollars = self.new_histories[:, start-1:stop]
+        returns = np.log(dollars[:, 1:] / dollars[:, :-1])
+
+        cols = slice(self.len_past + start, self.len_past + stop)
+        np.cumsum(returns, axis=1, out=self.sums[:, cols])
+        self.sums[:, cols] += self.sums[:, [self.len_past + start - 1]]
+        np.cumsum(returns ** 2, axis=1, out=self.sq_sums[:, cols])
+        self.sq_sums[:, cols] += self.sq_sums[:, [self.len_past + start - 1]]
+        self.num_filled = stop
+
+    def rewind(self, start):
+        """
+        Drop the days from |start| on from the sums, so that they're read again (e.g. after the new histories
+        were rewritten from day |start| on).
+        """
+        self.num_filled = max(1, min(self.num_filled, start))
+
+    def get_sharpe_ratios(self, start, stop):
+        """
+        Annualized Sharpe ratios of the log returns of dollars[start:stop] of each series (like
+        util.empirical_sharpe_ratio on that window). |start| may be negative to reach into the past histories.
+        |start| and |stop| may also be arrays of windows (e.g. one per day) to get all of them at once.
+
+        :return: Array with the Sharpe ratio of each series (num_series x num_windows if given arrays)
+        """
+        start = np.asarray(start)
+        stop = np.asarray(stop)
+        if np.any(start < -self.len_past):
+            raise Exception('Invalid window from ' + str(np.min(start)) + ' to ' + str(stop.flat[0]) +
+                            ' with only ' + str(self.len_past) + ' days of prior history available.')
+        self.advance(np.max(stop))
+
+        num_returns = stop - start - 1
+        first = self.len_past + start
+        last = self.len_past + stop - 1
+        mean = (self.sums[:, last] - self.sums[:, first]) / num_returns
+        var = (self.sq_sums[:, last] - self.sq_sums[:, first]) / num_returns - mean ** 2
+        return np.sqrt(days_per_year) * mean / np.sqrt(np.maximum(var, 0))
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held in memory
+        """
+        return self.sums.nbytes + self.sq_sums.nbytes
@@ -1,28 +1,85 @@
-import numpy as np
+import copy
+import os
+from allocation_file import AllocationReader
+from allocation_service import AllocationService
+from expert_pool import ExpertPool
+from olmar import OLMAR
+from rmr import RMR
+import util
+
+train_results_dir = 'train_results/'
+# (class, name, trained hyperparameters as {name in hyperparams.txt: keyword argument}) of each live expert
+live_experts = [
+    (OLMAR, 'OLMAR', {'Window': 'window', 'Epsilon': 'eps'}),
+    (RMR, 'RMR', {'Window': 'window', 'Epsilon': 'eps', 'Tau': 'tau'}),
+]
+allocation_fpath = 'results/test_allocation.npy'  # Precomputed allocations (see Portfolio.enable_allocation_file)
+test_horizon = 252  # Number of test days to reserve room for in the market data
+
+_service = None  # Warm allocation service, created on day 0
+_reader = None  # Reader for precomputed allocations
+
+
+def make_live_portfolio(market_data):
+    """
+    Create the portfolio used for live trading: an ExpertPool of OLMAR and RMR with the hyperparameters
+    selected in training (the experts don't tune while trading, so that each day is served quickly).
+    An expert whose training results include its allocation history is warm started from them. Otherwise it
+    starts from a uniform allocation with the trained hyperparameters, and a warning is printed.
+    """
+    experts = []
+    for (expert_class, name, param_names) in live_experts:
+        past_results_dir = train_results_dir + name + '/'
+        if not os.path.exists(past_results_dir + 'hyperparams.txt'):
+            raise Exception('No training results for ' + name + ' in ' + past_results_dir)
+
+        kwargs = {}
+        if not (os.path.exists(past_results_dir + 'b_history.npy') or
+                os.path.exists(past_results_dir + 'b_history.txt')):
+            print 'WARNING: No allocation history in ' + past_results_dir + ', so ' + name + \
+                  ' starts from a uniform allocation (with the trained hyperparameters)'
+            hyperparams = util.load_hyperparams(past_results_dir, param_names.keys())
+            for param in param_names:
+                if param not in hyperparams:
+                    raise Exception(param + ' is missing from ' + past_results_dir + 'hyperparams.txt')
+                kwargs[param_names[param]] = hyperparams[param]
+            kwargs['window'] = int(kwargs['window'])
+            past_results_dir = None
+        experts.append(expert_class(market_data=market_data, tune_interval=None, silent=True,
+                                    past_results_dir=past_results_dir, **kwargs))
+    return ExpertPool(market_data=market_data, experts=experts, silent=True)
+
 
 def run_portfolio(day, test_data):
     """
 
-    :param day:
-    :param market_data:
-    :return:
+    :param day: 0-based index of the current test day
+    :param test_data: MarketData object holding the test prices up to (and including) |day|
+    :return: Allocation for the end of |day|
     """
+    global _service, _reader
+
+    if os.path.exists(allocation_fpath):
+        # Replay precomputed allocations
+        if _reader is None:
+            _reader = AllocationReader(allocation_fpath)
+        return _reader.get_allocation(day)
+
+    if day == 0 or _service is None:
+        # Create the warm service once. Later days only advance it by 1 day. The service gets its own copy
+        # of the market data with room for the whole test horizon, so the caller's |test_data| isn't modified.
+        live_data = copy.deepcopy(test_data)
+        live_data.reserve_days(test_horizon)
+        _service = AllocationService(make_live_portfolio(live_data))
 
-    allocation_fpath = 'results/test_allocation.txt'
-
-    if day == 0:
-        # Load train and test data.
-
-        # Run our codes and save to output file
-        results = [[]]  # num days x num stocks
-        np.savetxt(allocation_fpath, results, delimiter='\t')
-        return results[0]
-    else:
-        # Read the current day's results from output file
-        results_file = open(allocation_fpath)
-        for (i, line) in enumerate(allocation_fpath):
-            if i == day:
-                vals = line.split('\t')
-                cur_alloc = [float(val) for val in vals]
-                results_file.close()
-                return cur_alloc
+    prices = None
+    if test_data is not _service.data:
+        # New prices arrived in a different MarketData object, so copy today's prices over
+        prices = {
+            'vol': test_data.get_vol(relative=False)[day, :],
+            'op': test_data.get_op(relative=False)[day, :],
+            'lo': test_data.get_lo(relative=False)[day, :],
+            'hi': test_data.get_hi(relative=False)[day, :],
+            'cl': test_data.get_cl(relative=False)[day, :],
+        }
+    return _service.allocate(day=day, prices=prices)
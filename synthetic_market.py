@@ -0,0 +1,67 @@
+"""
+    Deterministic synthetic stock market generator.
+
+    Produces MarketData objects with any number of stocks and days, so that the strategies
+    can be benchmarked beyond the 497 stock data set. The generated data reproduces the
+    quirks of the real data:
+        - Late listings: some stocks have no data (NaN) until a listing day, like CFN
+          (which has no data until day 827 of the training set).
+        - Sporadic missing days where all of a stock's prices are NaN.
+        - Volatility regimes: the days are split into consecutive segments with
+          different daily volatilities.
+
+"""
+
+import numpy as np
+from market_data import MarketData
+
+
+def generate_market_data(num_stocks=100, num_days=250, seed=0, regime_vols=(0.01, 0.03, 0.015),
+                         drift=0.0003, late_listing_frac=0.05, missing_frac=0.001, market_corr=0.3):
+    """
+    :param num_stocks: Number of stocks
+    :param num_days: Number of trading days
+    :param seed: Seed of the random number generator (the same seed always gives the same market)
+    :param regime_vols: Daily volatility of each regime. The days are split evenly between the regimes.
+    :param drift: Mean daily log return
+    :param late_listing_frac: Fraction of stocks that are listed after the 1st day
+    :param missing_frac: Fraction of (day, stock) entries that are missing
+    :param market_corr: Fraction of each stock's variance explained by a common market factor
+    :return: MarketData object
+    """
+    rng = np.random.RandomState(seed)
+
+    # Daily volatility of each day according to its regime
+    regime_idxs = np.minimum((np.arange(num_days) * len(regime_vols)) // num_days, len(regime_vols) - 1)
+    day_vols = np.array(regime_vols)[regime_idxs].reshape(-1, 1)
+
+    # Log returns = common market factor + idiosyncratic noise, split into overnight and intraday moves
+    market = rng.randn(num_days, 1)
+    noise = rng.randn(num_days, num_stocks)
+    log_returns = drift + day_vols * (np.sqrt(market_corr) * market + np.sqrt(1 - market_corr) * noise)
+    overnight_frac = rng.uniform(0.2, 0.5, size=(num_days, num_stocks))
+
+    init_prices = np.exp(rng.uniform(np.log(5), np.log(500), size=num_stocks))
+    log_cl = np.log(init_prices) + np.cumsum(log_returns, axis=0)
+    log_op = log_cl - (1 - overnight_frac) * log_returns
+    cl = np.exp(log_cl)
+    op = np.exp(log_op)
+
+    intraday_range = day_vols * np.abs(rng.randn(num_days, num_stocks))
+    hi = np.maximum(op, cl) * np.exp(intraday_range)
+    lo = np.minimum(op, cl) * np.exp(-intraday_range)
+    vol = np.round(np.exp(rng.normal(13, 1, size=(num_days, num_stocks))))
+
+    # Missing data
+    missing = rng.rand(num_days, num_stocks) < missing_frac
+    num_late = int(round(late_listing_frac * num_stocks))
+    late_stocks = rng.choice(num_stocks, size=num_late, replace=False)
+    for stock in late_stocks:
+        listing_day = rng.randint(1, max(2, num_days))
+        missing[:listing_day, stock] = True
+
+    for prices in (op, cl, hi, lo, vol):
+        prices[missing] = np.NaN
+
+    stock_names = ['SYN' + str(i) for i in range(num_stocks)]
+    return MarketData(vol, op, lo, hi, cl, stock_names)
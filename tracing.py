@@ -0,0 +1,111 @@
+"""
+    Optional tracer that records the nesting of work in a backtest as Chrome trace events.
+
+    Usage:
+        tracing.start_tracing()
+        portfolio.run()
+        tracing.stop_tracing('trace.json')
+
+    Then open trace.json in chrome://tracing (or https://ui.perfetto.dev). Code is instrumented
+    with spans:
+        with tracing.span('update', day=cur_day):
+            ...
+    When tracing is off, span returns a shared do-nothing context manager.
+
+"""
+
+import json
+import os
+import threading
+from timeit import default_timer
+
+_tracer = None  # The active Tracer (None when tracing is off)
+
+
+class Tracer(object):
+
+    def __init__(self):
+        self.events = []
+        self.pid = os.getpid()
+        self.start_time = default_timer()
+
+    def add_complete_event(self, name, start_time, stop_time, args):
+        """
+        Record a span as a complete ('X') event. Times are converted to microseconds since the tracer started.
+        """
+        self.events.append({
+            'name': name,
+            'ph': 'X',
+            'ts': 1e6 * (start_time - self.start_time),
+            'dur': 1e6 * (stop_time - start_time),
+            'pid': self.pid,
+            'tid': threading.current_thread().ident,
+            'args': args,
+        })
+
+    def save(self, path):
+        out_file = open(path, 'w')
+        json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, out_file)
+        out_file.close()
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start_time = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer.add_complete_event(self.name, self.start_time, default_timer(), self.args)
+        return False
+
+
+class _NullSpan(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_null_span = _NullSpan()
+
+
+def span(name, **args):
+    """
+    :param name: Name of the span shown in the trace viewer
+    :param args: Extra values to attach to the span (e.g. the day)
+    :return: Context manager that records the span if tracing is on
+    """
+    if _tracer is None:
+        return _null_span
+    return _Span(_tracer, name, args)
+
+
+def start_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+
+def stop_tracing(path=None):
+    """
+    Stop tracing and optionally save the trace to |path|.
+
+    :return: The Tracer that was active
+    """
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is not None and path is not None:
+        tracer.save(path)
+    return tracer
+
+
+def is_tracing():
+    return _tracer is not None
@@ -1,42 +1,280 @@
+"""
+    Generic hyperparameter tuner for any Portfolio class.
+
+    Runs the portfolio once for every combination of the tuning parameters (a grid search), ranks the
+    configurations by Sharpe ratio and prints the table. The configurations are evaluated in parallel
+    worker processes that are forked after the market data is loaded, so they all read the same
+    MarketData instead of each loading (or being sent) a copy. Each finished configuration is appended
+    to a results file (one JSON object per line), so an interrupted sweep can be resumed: configurations
+    that are already in the results file are not run again. Each result also records the setup of the
+    sweep (the strategy, the fixed parameters and the market data), and a sweep refuses to resume from
+    a results file written with a different setup.
+
+    Usage:
+        python tune_parameters.py --strategy olmar.OLMAR --param window=5,10,20 --param eps=1.1,1.5,2 \\
+            --fixed tune_interval=None --results results/tune_olmar.jsonl
+
+"""
+
+import argparse
+import ast
+import importlib
 import itertools
+import json
+import multiprocessing
+import os
+from timeit import default_timer
+import numpy as np
+from result_cache import ResultCache
+from util import format_value, load_matlab_sp500_data
+
+default_data_path = 'data/market_data_train.mat'
+
+# (portfolio class, market data, fixed parameters, result cache) of the configurations evaluated in this process
+_worker_context = None
+
+
+def get_all_combinations(tuning_params):
+    """
+    :param tuning_params: Dictionary mapping the name of each tuning parameter to a list of its values
+    :return: List with a dictionary of parameter values for every combination (the cartesian product)
+    """
+    names = sorted(tuning_params.keys())
+    value_lists = [[to_json_value(val) for val in tuning_params[name]] for name in names]
+    return [dict(zip(names, values)) for values in itertools.product(*value_lists)]
+
+
+def to_json_value(val):
+    """
+    :return: |val| as a plain Python value (e.g. numpy scalars from np.arange become floats)
+    """
+    if isinstance(val, np.generic):
+        return val.item()
+    return val
+
+
+def config_key(params):
+    return json.dumps(params, sort_keys=True)
+
+
+def get_setup(portfolio_class, market_data, named_params, data_path):
+    """
+    :return: Dictionary with what every configuration of a sweep shares: the strategy path, the fixed
+    parameters, the path of the market data and its fingerprint
+    """
+    return {
+        'strategy': portfolio_class.__module__ + '.' + portfolio_class.__name__,
+        'fixed': dict((name, to_json_value(val)) for (name, val) in named_params.iteritems()),
+        'data': data_path,
+        'market_data': market_data.fingerprint(),
+    }
+
+
+def init_worker(portfolio_class, market_data, named_params, cache_dir):
+    global _worker_context
+    cache = None if cache_dir is None else ResultCache(cache_dir)
+    _worker_context = (portfolio_class, market_data, named_params, cache)
+
+
+def evaluate_config(params):
+    """
+    Run the portfolio with the fixed parameters and |params| (in a process set up by init_worker).
+
+    :return: Dictionary with the parameters, the Sharpe ratio, final dollars and run time, or the error
+    if the portfolio couldn't be run with these parameters
+    """
+    portfolio_class, market_data, named_params, cache = _worker_context
+    kwargs = dict(named_params)
+    kwargs.update(params)
+    kwargs.setdefault('silent', True)
+
+    result = {'params': params}
+    start_time = default_timer()
+    try:
+        portfolio = portfolio_class(market_data=market_data, **kwargs)
+        if cache is not None:
+            portfolio.enable_result_cache(cache)
+        portfolio.run()
+        result['sharpe'] = float(portfolio.sharpe)
+        result['final_dollars'] = float(portfolio.get_dollars_history()[-1])
+    except Exception as e:
+        result['error'] = e.__class__.__name__ + ': ' + str(e)
+    result['seconds'] = default_timer() - start_time
+    return result
+
+
+def load_results(results_path):
+    """
+    :return: List of the results in |results_path| (a partially written last line is skipped)
+    """
+    if results_path is None or not os.path.exists(results_path):
+        return []
+    results = []
+    results_file = open(results_path)
+    for line in results_file:
+        try:
+            results.append(json.loads(line))
+        except ValueError:
+            pass
+    results_file.close()
+    return results
+
+
+def rank_results(results):
+    """
+    :return: |results| sorted by Sharpe ratio (best first, ties in the order of the parameters).
+    Configurations that failed or have an undefined Sharpe ratio come last.
+    """
+    def sort_key(result):
+        sharpe = result.get('sharpe')
+        if sharpe is None or np.isnan(sharpe):
+            return (1, 0, config_key(result['params']))
+        return (0, -sharpe, config_key(result['params']))
+    return sorted(results, key=sort_key)
+
+
+def tune_parameters(portfolio_class, market_data, tuning_params, named_params=None, results_path=None,
+                    processes=None, cache_dir=None, data_path=None):
+    """
+    Evaluate every combination of |tuning_params| and rank the configurations by Sharpe ratio.
+
+    :param portfolio_class: Portfolio subclass to tune (e.g. OLMAR)
+    :param market_data: MarketData to run on (shared by all of the worker processes)
+    :param tuning_params: Dictionary mapping the names of the tuning parameters to lists of values
+    :param named_params: Dictionary of fixed keyword arguments of |portfolio_class| (e.g. tune_interval)
+    :param results_path: File to append each result to. Configurations that already succeeded in this file
+    are not run again, so an interrupted sweep can be resumed (failed configurations are retried). Raises an exception if the file has results
+    of a different setup (see get_setup).
+    :param processes: Number of worker processes (default: number of CPUs). 1 runs in this process.
+    :param cache_dir: Directory of a ResultCache shared by the workers (optional)
+    :param data_path: Path that |market_data| was loaded from (recorded in the setup of the results)
+    :return: List of result dictionaries (see evaluate_config, plus the setup) ranked by Sharpe ratio
+    """
+    if named_params is None:
+        named_params = {}
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    setup = get_setup(portfolio_class, market_data, named_params, data_path)
+    results = load_results(results_path)
+    for result in results:
+        if config_key(result.get('setup')) != config_key(setup):
+            raise Exception('Can\'t resume from ' + results_path + ': its results are from a different setup ('
+                            + config_key(result.get('setup')) + ' instead of ' + config_key(setup) + ')')
+    # Failures may be transient, so only successful results count as done and the rest are run again
+    num_failed = len([result for result in results if 'error' in result])
+    results = [result for result in results if 'error' not in result]
+    done = set(config_key(result['params']) for result in results)
+    configs = [params for params in get_all_combinations(tuning_params) if config_key(params) not in done]
+    if results or num_failed:
+        print 'Resuming:', len(results), 'configurations done,', len(configs), 'left (' + str(num_failed), \
+            'failed results are retried)'
+
+    if results_path is not None:
+        results_dir = os.path.dirname(results_path)
+        if results_dir and not os.path.exists(results_dir):
+            os.makedirs(results_dir)
+        results_file = open(results_path, 'a')
+
+    init_args = (portfolio_class, market_data, named_params, cache_dir)
+    if processes == 1 or len(configs) <= 1:
+        init_worker(*init_args)
+        new_results = itertools.imap(evaluate_config, configs)
+        pool = None
+    else:
+        # The workers are forked with the market data, so only the parameters are sent to them
+        pool = multiprocessing.Pool(processes, initializer=init_worker, initargs=init_args)
+        new_results = pool.imap_unordered(evaluate_config, configs)
+
+    try:
+        for result in new_results:
+            result['setup'] = setup
+            results.append(result)
+            if results_path is not None:
+                results_file.write(json.dumps(result, sort_keys=True) + '\n')
+                results_file.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        if results_path is not None:
+            results_file.close()
+
+    return rank_results(results)
+
+
+def print_results(results, num_results=10):
+    print 'Rank  Sharpe  Final $  Seconds  Configuration'
+    for (rank, result) in enumerate(results[:num_results]):
+        params = ', '.join(name + '=' + format_value(result['params'][name]) for name in sorted(result['params']))
+        if 'error' in result:
+            print '%4d  %6s  %7s  %7.2f  %s (%s)' % (rank + 1, '-', '-', result['seconds'], params, result['error'])
+        else:
+            print '%4d  %6.3f  %7.4f  %7.2f  %s' % (rank + 1, result['sharpe'], result['final_dollars'],
+                                                    result['seconds'], params)
+
+
+def parse_value(text):
+    """
+    Parse a parameter value given on the command line (numbers, None, True, lists, ...). Anything
+    else is kept as a string.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+def parse_param(text):
+    """
+    :return: (name, list of values) of an argument like 'window=5,10,20'
+    """
+    if '=' not in text:
+        raise Exception('Parameters must look like name=value1,value2,... (got ' + text + ')')
+    name, values = text.split('=', 1)
+    return name, [parse_value(val) for val in values.split(',')]
+
+
+def parse_fixed_param(text):
+    """
+    :return: (name, value) of an argument like 'tune_interval=None' (the value may contain commas)
+    """
+    if '=' not in text:
+        raise Exception('Fixed parameters must look like name=value (got ' + text + ')')
+    name, value = text.split('=', 1)
+    return name, parse_value(value)
+
+
+def load_class(path):
+    """
+    :return: The class at |path| (e.g. 'olmar.OLMAR')
+    """
+    module_name, class_name = path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Grid search over the hyperparameters of a portfolio.')
+    parser.add_argument('--strategy', required=True, help='Portfolio class to tune, e.g. olmar.OLMAR')
+    parser.add_argument('--param', action='append', default=[],
+                        help='Tuning parameter and its comma separated values, e.g. window=5,10,20 (repeatable)')
+    parser.add_argument('--fixed', action='append', default=[],
+                        help='Fixed parameter, e.g. tune_interval=None (repeatable)')
+    parser.add_argument('--data', default=default_data_path, help='Market data (.mat) to run on')
+    parser.add_argument('--results', default=None,
+                        help='JSON lines file to append the results to (and to resume from)')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes (default: # of CPUs)')
+    parser.add_argument('--cache-dir', default=None, help='Directory of a result cache shared by the workers')
+    parser.add_argument('--top', type=int, default=10, help='Number of configurations to print')
+    args = parser.parse_args()
+
+    tuning_params = dict(parse_param(text) for text in args.param)
+    if not tuning_params:
+        raise Exception('Give at least 1 tuning parameter with --param.')
+    named_params = dict(parse_fixed_param(text) for text in args.fixed)
 
-def get_all_combinations(list1, list2):
-	pairs = None
-	if len(list1) > len(list2):
-		permutations = itertools.permutations(list1,len(list2))
-		pairs = [zip(perm, list2) for perm in permutations]
-	else:
-		permutations = itertools.permutations(list2, len(list1))
-		pairs = [zip(list1, perm) for perm in permutations]
-	combinations = []
-	for p in pairs:
-		for match in p:
-			combinations.append(match[0] + match[1])
-	return combinations
-
-def tune_parameters(un_named_params, named_params, tuning_params):
-	'''
-	Method for tuning parameters during runtime.
-
-	:param: un_named_params - a TUPLE containing parameters without default values
-	:param: named_params 	- a DICTIONARY mapping static parameter names to values
-	:param: tuning_params	- a DICTIONARY mapping names of tuning parameters to a
-								list specifying a range of values to tune
-	'''
-	keys = [key for key in tuning_params]
-	param_combos = [[elem] for elem in tuning_params[keys[0]]]
-	for i in range(1,len(keys)):
-		key = keys[i]
-		param_combos = get_all_combinations(param_combos, [[elem] for elem in tuning_params[key]])
-
-	for params in param_combos:
-		param_dict = {}
-		for i in range(len(keys)):
-			param_dict[keys[i]] = params[i]
-
-		portfolio = Portfolio(*un_named_params, **named_params, **param_dict)
-		portfolio.run()
-
-		# TODO: get sharpe ratio
-
-tune_parameters()
\ No newline at end of file
+    market_data = load_matlab_sp500_data(args.data)
+    results = tune_parameters(load_class(args.strategy), market_data, tuning_params, named_params=named_params,
+                              results_path=args.results, processes=args.processes, cache_dir=args.cache_dir,
+                              data_path=args.data)
+    print_results(results, args.top)
@@ -1,4 +1,4 @@
-import util
+import numpy as np
 from portfolio import Portfolio
 from util import get_uniform_allocation
 
@@ -7,22 +7,30 @@ class UniformBuyAndHoldPortfolio(Portfolio):
     """
     Uniform buy and hold portfolio (UBAH).
 
-    UBAH servers as a very simple baseline.
+    UBAH servers as a very simple baseline. It buys every available stock uniformly on the first day and
+    never trades again, so its allocation drifts with the prices.
     """
 
-    def run(self):
-        print 'Running UCRP'
-        for day in range(0, self.num_days):
-            self.update(day)
-        self.print_results()
-        self.save_results()
+    portfolio_type = 'UBAH'
 
-    def get_new_allocation(self, cur_day):
-        if cur_day == 0:
+    def get_new_allocation(self, cur_day, init=False):
+        if self.b is None:
             cur_day_op = self.data.get_op(relative=False)[cur_day, :]  # opening prices on |cur_day|
             return get_uniform_allocation(self.num_stocks, cur_day_op)
-        else:
+
+        # Let the holdings grow to today's closing prices (like the accounting does) and keep them as they are
+        # (no trades). Stocks with no price today don't grow.
+        day_idx = cur_day - self.start
+        is_active = self._active[cur_day]
+        values = np.array(self.b_history[:, day_idx])
+        self._accounting.grow(values, self._cl[cur_day], self.last_close_price, is_active)
+
+        b = np.zeros(self.num_stocks)
+        active_value = values[is_active].sum()
+        if active_value <= 0:
             return self.b
+        b[is_active] = values[is_active] / active_value
+        return b
 
     def print_results(self):
         print 30 * '-'
@@ -32,6 +40,5 @@ class UniformBuyAndHoldPortfolio(Portfolio):
         #plt.plot(self.dollars_hist)
         #plt.show()
 
-    def save_results(self):
-        output_fname = 'results/uniform_buy_and_hold_dollars_over_time.txt'
-        util.save_results(output_fname, self.dollars_history)
+    def get_hyperparams_dict(self):
+        return {}
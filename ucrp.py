@@ -30,3 +30,5 @@ class UniformConstantRebalancedPortfolio(Portfolio):
             print 30 * '-'
             Portfolio.print_results(self)
 
+    def get_hyperparams_dict(self):
+        return {}
@@ -1,6 +1,8 @@
 """
     Utilities file
 """
+import json
+import os
 import numpy as np
 from scipy import io
 from math import sqrt, isnan
@@ -36,13 +38,11 @@ def get_price_relatives(raw_prices):
     :return: Array of relative price changes
     """
     price_relatives = np.zeros(raw_prices.shape)
-    prev_row = raw_prices[0]
-    for (i, row) in enumerate(raw_prices[1:]):
-        for (j, price) in enumerate(row):
-            prev_price = prev_row[j]
-            if price != 0 and prev_price != 0:
-                price_relatives[i+1, j] = 1.0 * price / prev_price
-        prev_row = row
+    prices = raw_prices[1:]
+    prev_prices = raw_prices[:-1]
+    both_nonzero = np.logical_and(prices != 0, prev_prices != 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        price_relatives[1:][both_nonzero] = 1.0 * prices[both_nonzero] / prev_prices[both_nonzero]
     return price_relatives
 
 
@@ -267,7 +267,8 @@ def silent_divide(a,b):
         return np.nan_to_num(np.true_divide(a, b))
 
 
-def rebalance(value_vec, value_realizable, portfolio_dst):
+def rebalance(value_vec, value_realizable, portfolio_dst, method='iterative', tol=1e-12, max_iter=7,
+              return_residual=False):
     """
     (Referenced from the course staff)
 
@@ -289,18 +290,158 @@ def rebalance(value_vec, value_realizable, portfolio_dst):
 
     % Output:
     %%% new_value_vec: the value vector after rebalancing
-    %%% trans_cost: the total transaction cost"""
+    %%% trans_cost: the total transaction cost
 
-    iter_num = 7
-    trans_cost = 0
-    for iter in range(iter_num):
-        trans_cost = np.sum(cost_per_dollar * np.abs(portfolio_dst * \
-                                               (value_realizable-trans_cost)-value_vec))
+    A batch of portfolios can be rebalanced at once by passing (num_portfolios x num_stocks)
+    |value_vec| and |portfolio_dst| together with a length num_portfolios |value_realizable|.
+    See solve_trans_cost for |method|, |tol| and |max_iter|. If |return_residual| is True, the
+    residual of the cost equation is returned as a 3rd output."""
+
+    if return_residual:
+        trans_cost, residual = solve_trans_cost(value_vec, value_realizable, portfolio_dst,
+                                                method=method, tol=tol, max_iter=max_iter)
+    else:
+        trans_cost = _solve_trans_cost(value_vec, value_realizable, portfolio_dst, method, tol, max_iter)
 
-    new_value_vec = portfolio_dst * (value_realizable - trans_cost)
+    new_value_vec = portfolio_dst * np.expand_dims(value_realizable - trans_cost, axis=-1)
+    if return_residual:
+        return new_value_vec, trans_cost, residual
     return new_value_vec, trans_cost
 
 
+def rebalance_in_place(value_vec, value_realizable, portfolio_dst, work, tol=1e-12, max_iter=7):
+    """
+    Version of rebalance that works in place (uses the iterative solver). For a single portfolio it doesn't
+    allocate any arrays. A batch of portfolios is passed like in rebalance.
+
+    :param value_vec: Current values of each stock. Overwritten with the values after rebalancing.
+    :param work: Preallocated array with the same shape as |value_vec|.
+    :return: The total transaction cost
+    """
+    if np.ndim(value_realizable) == 0:
+        value_realizable = float(value_realizable)
+        trans_cost = _solve_trans_cost_iterative(value_vec, value_realizable, portfolio_dst, tol, max_iter, work=work)
+        np.multiply(portfolio_dst, value_realizable - trans_cost, out=value_vec)
+    else:
+        value_realizable = np.asarray(value_realizable, dtype=float)
+        trans_cost = _solve_trans_cost_iterative(value_vec, value_realizable, portfolio_dst, tol, max_iter, work=work)
+        np.multiply(portfolio_dst, (value_realizable - trans_cost)[:, np.newaxis], out=value_vec)
+    return trans_cost
+
+
+def solve_trans_cost(value_vec, value_realizable, portfolio_dst, method='iterative', tol=1e-12, max_iter=7):
+    """
+    Solve the transaction cost equation of rebalance for C:
+
+        C = cost_per_dollar * sum( abs( portfolio_dst * (value_realizable - C) - value_vec ) )
+
+    :param method: 'iterative' runs the fixed point iteration and stops as soon as every portfolio's
+    update is below |tol| * |value_realizable| (at most |max_iter| iterations). 'exact' finds the root
+    of the piecewise linear equation directly by searching over its breakpoints.
+    :return: (trans_cost, residual) where residual = |C - cost_per_dollar * sum(...)|. Both are scalars
+    for a single portfolio and arrays of length num_portfolios for a batch.
+    """
+
+    trans_cost = _solve_trans_cost(value_vec, value_realizable, portfolio_dst, method, tol, max_iter)
+    target_vec = portfolio_dst * np.expand_dims(value_realizable - trans_cost, axis=-1)
+    residual = np.abs(trans_cost - cost_per_dollar * np.sum(np.abs(target_vec - value_vec), axis=-1))
+    return trans_cost, residual
+
+
+def _solve_trans_cost(value_vec, value_realizable, portfolio_dst, method, tol, max_iter):
+    value_realizable = np.asarray(value_realizable, dtype=float)
+    if method == 'iterative':
+        return _solve_trans_cost_iterative(value_vec, value_realizable, portfolio_dst, tol, max_iter)
+    elif method == 'exact':
+        return _solve_trans_cost_exact(value_vec, value_realizable, portfolio_dst)
+    else:
+        raise Exception('Invalid method passed to solve_trans_cost. Method must be 1 of: iterative, exact')
+
+
+def _solve_trans_cost_iterative(value_vec, value_realizable, portfolio_dst, tol, max_iter, work=None):
+    # Reuse a single work array instead of creating temporaries on every iteration
+    if work is None:
+        work = np.empty(np.broadcast(value_vec, portfolio_dst).shape)
+
+    if np.ndim(value_realizable) == 0:
+        # Single portfolio: keep the cost as a python float to avoid array overhead in the loop
+        realizable = float(value_realizable)
+        thresh = tol * abs(realizable)
+        trans_cost = 0.0
+        for iter in range(max_iter):
+            np.multiply(portfolio_dst, realizable - trans_cost, out=work)
+            np.subtract(work, value_vec, out=work)
+            np.abs(work, out=work)
+            new_trans_cost = cost_per_dollar * float(work.sum())
+            converged = abs(new_trans_cost - trans_cost) <= thresh
+            trans_cost = new_trans_cost
+            if converged:
+                break
+        return trans_cost
+
+    realizable = value_realizable[..., np.newaxis]
+    thresh = tol * np.abs(realizable)
+    trans_cost = 0
+    for iter in range(max_iter):
+        np.multiply(portfolio_dst, realizable - trans_cost, out=work)
+        np.subtract(work, value_vec, out=work)
+        np.abs(work, out=work)
+        new_trans_cost = cost_per_dollar * np.sum(work, axis=-1, keepdims=True)
+        converged = (np.abs(new_trans_cost - trans_cost) <= thresh).all()
+        trans_cost = new_trans_cost
+        if converged:
+            break
+    return trans_cost[..., 0]
+
+
+def _solve_trans_cost_exact(value_vec, value_realizable, portfolio_dst):
+    """
+    With x = value_realizable - C, the equation becomes g(x) = 0 where
+
+        g(x) = x - value_realizable + cost_per_dollar * sum( |p_i| * |x - v_i/p_i| )
+
+    g is piecewise linear with breakpoints at v_i/p_i and (as long as cost_per_dollar * sum(|p_i|) < 1)
+    strictly increasing. So we evaluate g at the sorted breakpoints, count how many lie below the root
+    and solve the linear equation on that segment.
+    """
+
+    r = cost_per_dollar
+    value_vec, portfolio_dst = np.broadcast_arrays(value_vec, portfolio_dst)
+    value_mat = np.atleast_2d(value_vec)
+    dst_mat = np.atleast_2d(portfolio_dst)
+    realizable = np.atleast_1d(value_realizable)
+
+    # Stocks with portfolio_dst = 0 are sold completely, which contributes a constant cost
+    held = dst_mat != 0
+    weights = np.abs(dst_mat)
+    breaks = silent_divide(value_mat, np.where(held, dst_mat, 1))
+    breaks[~held] = 0
+    const = r * np.sum(np.abs(value_mat) * ~held, axis=1)
+
+    order = np.argsort(breaks, axis=1)
+    breaks = np.take_along_axis(breaks, order, axis=1)
+    weights = np.take_along_axis(weights, order, axis=1)
+    cum_w = np.cumsum(weights, axis=1)
+    cum_wt = np.cumsum(weights * breaks, axis=1)
+    tot_w = cum_w[:, -1:]
+    tot_wt = cum_wt[:, -1:]
+
+    g_breaks = breaks - realizable[:, np.newaxis] + const[:, np.newaxis] + \
+        r * (breaks * (2 * cum_w - tot_w) - (2 * cum_wt - tot_wt))
+    num_below = np.sum(g_breaks < 0, axis=1)
+
+    # Weight (and weighted breakpoint sum) of the breakpoints below the root
+    cum_w = np.concatenate((np.zeros((cum_w.shape[0], 1)), cum_w), axis=1)
+    cum_wt = np.concatenate((np.zeros((cum_wt.shape[0], 1)), cum_wt), axis=1)
+    rows = np.arange(cum_w.shape[0])
+    w_below = cum_w[rows, num_below]
+    wt_below = cum_wt[rows, num_below]
+
+    x = (realizable - const + r * (2 * wt_below - tot_wt[:, 0])) / (1 + r * (2 * w_below - tot_w[:, 0]))
+    trans_cost = realizable - x
+    return trans_cost.reshape(np.shape(value_realizable))
+
+
 def save_dollars_history(save_dir, dollars, portfolio_type):
     dollars_hist_file = save_dir + 'dollars_history.txt'
     header = 'Dollars held by ' + portfolio_type + ' portfolio at market open on each day of training set.'
@@ -347,3 +488,90 @@ def load_hyperparams(past_results_dir, params):
                 hyperparams_dict[param] = val
     return hyperparams_dict
 
+
+def save_binary_results(save_dir, portfolio_type, dollars, b_history=None, hyperparams_dict=None, start=None, stop=None):
+    """
+    Save the results of a run in binary format:
+        dollars_history.npy: Dollars held at market open on each day
+        b_history.npy: (num_stocks x num_days) allocation on each day
+        results_meta.json: Portfolio type, hyperparameters and the range of days that was run
+
+    The .npy files can be memory mapped by load_binary_results, so loading is instant even for long runs.
+    """
+    np.save(save_dir + 'dollars_history.npy', dollars)
+    if b_history is not None:
+        np.save(save_dir + 'b_history.npy', b_history)
+
+    metadata = {
+        'portfolio_type': portfolio_type,
+        'hyperparams': hyperparams_dict if hyperparams_dict is not None else {},
+        'start': start,
+        'stop': stop,
+        'num_days': len(dollars),
+    }
+    meta_file = open(save_dir + 'results_meta.json', 'w')
+    json.dump(metadata, meta_file, indent=2, sort_keys=True)
+    meta_file.close()
+
+
+def load_binary_results(results_dir, mmap_mode='r'):
+    """
+    Load results saved by save_binary_results.
+
+    :param results_dir: Path to the results directory
+    :param mmap_mode: Memory mapping mode passed to np.load (None loads the arrays into memory)
+    :return: (b_history, dollars_history, metadata). b_history is None if it wasn't saved.
+    """
+    dollars = np.load(results_dir + 'dollars_history.npy', mmap_mode=mmap_mode)
+
+    b_history = None
+    if os.path.exists(results_dir + 'b_history.npy'):
+        b_history = np.load(results_dir + 'b_history.npy', mmap_mode=mmap_mode)
+
+    metadata = {}
+    if os.path.exists(results_dir + 'results_meta.json'):
+        meta_file = open(results_dir + 'results_meta.json')
+        metadata = json.load(meta_file)
+        meta_file.close()
+    return b_history, dollars, metadata
+
+
+def has_binary_results(results_dir):
+    return os.path.exists(results_dir + 'dollars_history.npy')
+
+
+def load_text_results(results_dir):
+    """
+    Load results saved in the old tab-delimited text format.
+
+    :return: (b_history, dollars_history). b_history is None if the file doesn't exist.
+    """
+    dollars = np.loadtxt(results_dir + 'dollars_history.txt', delimiter='\t')
+
+    b_history = None
+    if os.path.exists(results_dir + 'b_history.txt'):
+        b_history = np.loadtxt(results_dir + 'b_history.txt', delimiter='\t')
+    return b_history, dollars
+
+
+def load_all_hyperparams(past_results_dir):
+    """
+    :return: Dictionary mapping every hyperparameter in hyperparams.txt to its value (as a string).
+    """
+    hyperparams_dict = {}
+    hyp_file = open(past_results_dir + 'hyperparams.txt')
+    for line in hyp_file:
+        if line[0] != '#':
+            vals = line.rstrip().split('\t')
+            hyperparams_dict[vals[0]] = vals[1]
+    hyp_file.close()
+    return hyperparams_dict
+
+
+def format_value(val):
+    """
+    :return: |val| as a string for printing a configuration (floats in %g form, e.g. 0.5 or 1e-05).
+    """
+    if isinstance(val, float):
+        return '%g' % val
+    return str(val)